@@ -0,0 +1,162 @@
+#! /usr/bin/python
+
+#    Copyright (c) 2013 Vincenzo Pii <vinc.pii@gmail.com>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version, with the following additional
+#    restriction:
+#    you cannot modify or redistribute this software if you don't use your
+#    own Remember The Milk API Key and Shared Secret pair, or receive explicit
+#    permission from the author (<vinc.pii@gmail.com>) to include your
+#    changes to the code.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#    This product uses the Remember The Milk API but is not endorsed or
+#    certified by Remember The Milk.
+
+
+
+'''
+Synthetic Remember The Milk responses for the benchmarks: the XML of
+rtm.tasks.getList and rtm.lists.getList for an account with a given
+number of tasks, with the same structure as the real ones.
+'''
+
+import random
+from datetime import datetime, timedelta
+from xml.sax.saxutils import quoteattr, escape
+
+# Words used for the names of tasks and lists (some with diacritics)
+WORDS = (u'report', u'call', u'buy', u'milk', u'review', u'deploy', u'write',
+         u'draft', u'meeting', u'invoice', u'dentist', u'groceries', u'book',
+         u'flight', u'hotel', u'renew', u'passport', u'fix', u'bug', u'release',
+         u'caf\xe9', u'r\xe9sum\xe9', u'na\xefve', u'\xfcbung', u'plan', u'budget',
+         u'garden', u'clean', u'garage', u'email', u'reply', u'slides', u'notes')
+
+LIST_NAMES = (u'Inbox', u'Personal', u'Work', u'Study', u'Sent', u'Shopping',
+              u'Travel', u'Home', u'Projects', u'Someday', u'Finance', u'Health')
+
+TAGS = (u'home', u'office', u'phone', u'errand', u'urgent', u'waiting')
+
+PRIORITIES = (u'N', u'N', u'N', u'1', u'2', u'2', u'3', u'3')
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Reference time of the generated data
+NOW = datetime(2013, 9, 15, 12, 0, 0)
+
+
+def listsCount(tasksCount):
+    '''
+    Number of lists of an account with tasksCount tasks
+    '''
+    return max(3, min(len(LIST_NAMES) * 4, tasksCount // 500))
+
+
+def listName(index):
+    name = LIST_NAMES[index % len(LIST_NAMES)]
+    if index >= len(LIST_NAMES):
+        name += u' %d' % (index // len(LIST_NAMES))
+    return name
+
+
+def _time(random, days):
+    return (NOW + timedelta(days = random.uniform(-days, days))).strftime(TIME_FORMAT)
+
+
+def _attributes(**attributes):
+    return u' '.join(u'%s=%s' % (key, quoteattr(value))
+                     for key, value in sorted(attributes.items()))
+
+
+def tasksXml(tasksCount, completedRatio = 0.3, seed = 0):
+    '''
+    Returns the rtm.tasks.getList response (UTF-8 encoded) of an account
+    with tasksCount task series, spread over listsCount(tasksCount) lists.
+    About completedRatio of the tasks are completed, 60% have a due date
+    and 5% are repeating (more than one task in the series).
+    '''
+    rand = random.Random(seed)
+    lists = listsCount(tasksCount)
+    # Lists are of different sizes, like real ones
+    weights = [rand.paretovariate(1.5) for _ in range(lists)]
+    series = [[] for _ in range(lists)]
+    for seriesId in xrange(tasksCount):
+        point = rand.uniform(0, sum(weights))
+        for listIndex, weight in enumerate(weights):
+            point -= weight
+            if point <= 0:
+                break
+        series[listIndex].append(seriesId)
+
+    parts = [u'<?xml version="1.0" encoding="UTF-8"?><rsp stat="ok"><tasks rev="%x">' % rand.getrandbits(64)]
+    for listIndex, ids in enumerate(series):
+        if not ids:
+            continue
+        parts.append(u'<list id="%d">' % (1000 + listIndex))
+        for seriesId in ids:
+            name = u' '.join(rand.choice(WORDS) for _ in range(rand.randint(2, 6)))
+            repeating = rand.random() < 0.05
+            parts.append(u'<taskseries %s>' % _attributes(
+                id = unicode(10000000 + seriesId),
+                created = _time(rand, 700),
+                modified = _time(rand, 30),
+                name = name,
+                source = rand.choice((u'js', u'api', u'email')),
+                url = rand.choice((u'', u'', u'http://www.example.com/%d' % seriesId)),
+                location_id = u''))
+            if repeating:
+                parts.append(u'<rrule every="1">FREQ=WEEKLY;INTERVAL=1</rrule>')
+            parts.append(u'<tags>')
+            for tag in rand.sample(TAGS, rand.randint(0, 2)):
+                parts.append(u'<tag>%s</tag>' % escape(tag))
+            parts.append(u'</tags><participants/>')
+            if rand.random() < 0.1:
+                parts.append(u'<notes><note id="%d" created="%s" modified="%s" title="">%s</note></notes>' %
+                             (seriesId, _time(rand, 100), _time(rand, 100),
+                              escape(u' '.join(rand.choice(WORDS) for _ in range(20)))))
+            else:
+                parts.append(u'<notes/>')
+            for taskIndex in range(rand.randint(2, 4) if repeating else 1):
+                hasDue = rand.random() < 0.6
+                parts.append(u'<task %s/>' % _attributes(
+                    id = unicode(20000000 + seriesId * 4 + taskIndex),
+                    due = _time(rand, 60) if hasDue else u'',
+                    has_due_time = rand.choice((u'0', u'1')) if hasDue else u'0',
+                    added = _time(rand, 700),
+                    completed = _time(rand, 200) if rand.random() < completedRatio else u'',
+                    deleted = u'',
+                    priority = rand.choice(PRIORITIES),
+                    postponed = u'0',
+                    estimate = u''))
+            parts.append(u'</taskseries>')
+        parts.append(u'</list>')
+    parts.append(u'</tasks></rsp>')
+    return u''.join(parts).encode('utf-8')
+
+
+def listsXml(tasksCount):
+    '''
+    Returns the rtm.lists.getList response (UTF-8 encoded) for the lists
+    of tasksXml(tasksCount), plus a smart list
+    '''
+    parts = [u'<?xml version="1.0" encoding="UTF-8"?><rsp stat="ok"><lists>']
+    for listIndex in range(listsCount(tasksCount)):
+        parts.append(u'<list %s/>' % _attributes(id = unicode(1000 + listIndex),
+                                                 name = listName(listIndex),
+                                                 deleted = u'0', locked = u'0',
+                                                 archived = u'0', position = u'-1',
+                                                 smart = u'0', sort_order = u'0'))
+    parts.append(u'<list id="999" name="Due this week" deleted="0" locked="0" archived="0"'
+                 u' position="0" smart="1" sort_order="0"><filter>(dueBefore:"1 week")</filter></list>')
+    parts.append(u'</lists></rsp>')
+    return u''.join(parts).encode('utf-8')
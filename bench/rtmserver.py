@@ -0,0 +1,401 @@
+#! /usr/bin/python
+
+#    Copyright (c) 2013 Vincenzo Pii <vinc.pii@gmail.com>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version, with the following additional
+#    restriction:
+#    you cannot modify or redistribute this software if you don't use your
+#    own Remember The Milk API Key and Shared Secret pair, or receive explicit
+#    permission from the author (<vinc.pii@gmail.com>) to include your
+#    changes to the code.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#    This product uses the Remember The Milk API but is not endorsed or
+#    certified by Remember The Milk.
+
+
+
+'''
+Local stand-in for the Remember The Milk REST API, to measure the lens
+without the real service (which is rate limited and slow).
+
+It implements the methods used by the lens: rtm.auth.getFrob, getToken
+and checkToken (every frob is authorized), rtm.tasks.getList (also with
+last_sync), rtm.lists.getList, rtm.timelines.create, rtm.tasks.complete
+and rtm.tasks.uncomplete. Requests must be signed with the shared secret.
+
+Usage: python bench/rtmserver.py [options]
+    --port 8080          port to listen on (localhost)
+    --tasks 1000         number of tasks of the account (see fixtures.py)
+    --latency 0          milliseconds added to every response
+    --jitter 0           maximum random milliseconds added to the latency
+    --error-rate 0       fraction of the requests failing (HTTP 503 or RTM
+                         error 105, half each)
+    --churn 0            task series changed by RTM before every
+                         rtm.tasks.getList (one in ten is deleted)
+    --api-key, --secret  API key and shared secret (default: the lens ones)
+    --token              token accepted without authentication
+
+The lens uses it when REMEMBER_THE_LENS_RTM_URL is set. Use a different
+HOME, so that the token, the tasks database and the pending writes of the
+real account are left alone, e.g.:
+    HOME=/tmp/rtl REMEMBER_THE_LENS_RTM_URL=http://localhost:8080 ./launch.sh
+'''
+
+import gzip
+import hashlib
+import os
+import random
+import sys
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from cStringIO import StringIO
+from optparse import OptionParser
+from xml.sax.saxutils import quoteattr
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'src'))
+
+import fixtures
+from rtmapi import iter_task_records, iter_list_records
+
+# API key and shared secret of the lens
+LENS_API_KEY = "b2d2254113dd2cd9dc773a62c5a9e337"
+LENS_SHARED_SECRET = "733e05a324352a7d"
+
+# Format of the times in the responses and of last_sync
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+class RtmError(Exception):
+    '''
+    Error answered with <rsp stat="fail"> (see
+    http://www.rememberthemilk.com/services/api/response.rtm)
+    '''
+    def __init__(self, code, message):
+        super(RtmError, self).__init__(message)
+        self.code = code
+        self.message = message
+
+
+class Task(object):
+    '''
+    A task series of the account, with its first task
+    '''
+    __slots__ = ('listId', 'taskSeriesId', 'taskId', 'name', 'due',
+                 'priority', 'completed', 'modified', 'deleted')
+
+    def __init__(self, record, modified):
+        self.listId = record.list_id
+        self.taskSeriesId = record.taskseries_id
+        self.taskId = record.task_id
+        self.name = record.name
+        self.due = record.due
+        self.priority = record.priority
+        self.completed = record.completed
+        self.modified = modified
+        self.deleted = None
+
+
+class RtmStandIn(object):
+    '''
+    State of the account and implementation of the API methods, each one
+    returning the content of <rsp stat="ok"> as a unicode string
+    '''
+
+    def __init__(self, tasksCount, apiKey = LENS_API_KEY, sharedSecret = LENS_SHARED_SECRET,
+                 token = None, churn = 0, seed = 0):
+        self.apiKey = apiKey
+        self.sharedSecret = sharedSecret
+        self.churn = churn
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._frobs = set()
+        self._tokens = set([token]) if token is not None else set()
+        self._timelines = set()
+        self._transactions = 0
+
+        created = self._now()
+        self._lists = list(iter_list_records(StringIO(fixtures.listsXml(tasksCount))))
+        self._tasks = {}
+        for record in iter_task_records(StringIO(fixtures.tasksXml(tasksCount, seed = seed))):
+            self._tasks[record.taskseries_id] = Task(record, created)
+        self._methods = {
+            'rtm.auth.getFrob': self.getFrob,
+            'rtm.auth.getToken': self.getToken,
+            'rtm.auth.checkToken': self.checkToken,
+            'rtm.lists.getList': self.getLists,
+            'rtm.tasks.getList': self.getTasks,
+            'rtm.timelines.create': self.createTimeline,
+            'rtm.tasks.complete': self.completeTask,
+            'rtm.tasks.uncomplete': self.uncompleteTask,
+        }
+
+    def _now(self):
+        return time.strftime(TIME_FORMAT, time.gmtime())
+
+    def signature(self, params):
+        '''
+        Signature of the request parameters (all but api_sig)
+        '''
+        pairs = sorted((key, value) for key, value in params.items() if key != 'api_sig')
+        request = self.sharedSecret + u''.join(key + value for key, value in pairs)
+        return hashlib.md5(request.encode('utf-8')).hexdigest()
+
+    def checkSignature(self, params):
+        if params.get('api_key') != self.apiKey:
+            raise RtmError(100, 'Invalid API Key')
+        if params.get('api_sig') != self.signature(params):
+            raise RtmError(96, 'Invalid signature')
+
+    def call(self, params):
+        '''
+        Runs the method of a REST request
+        '''
+        self.checkSignature(params)
+        method = self._methods.get(params.get('method'))
+        if method is None:
+            raise RtmError(112, 'Method "%s" not found' % params.get('method'))
+        with self._lock:
+            return method(params)
+
+    def authorize(self, params):
+        '''
+        Authorization page: the frob is authorized at once
+        '''
+        self.checkSignature(params)
+        with self._lock:
+            if params.get('frob') not in self._frobs:
+                raise RtmError(101, 'Invalid frob - did you authenticate?')
+            self._frobs.remove(params['frob'])
+            self._frobs.add(('authorized', params['frob']))
+
+    def _checkToken(self, params):
+        if params.get('auth_token') not in self._tokens:
+            raise RtmError(98, 'Login failed / Invalid auth token')
+
+    def _auth(self, token):
+        return (u'<auth><token>%s</token><perms>delete</perms>'
+                u'<user id="1" username="bench" fullname="Bench User"/></auth>' % token)
+
+    def getFrob(self, params):
+        frob = '%040x' % self._random.getrandbits(160)
+        self._frobs.add(frob)
+        return u'<frob>%s</frob>' % frob
+
+    def getToken(self, params):
+        frob = params.get('frob')
+        if frob in self._frobs:
+            # Not authorized yet, but nobody is there to click: accept it
+            self._frobs.remove(frob)
+        elif ('authorized', frob) in self._frobs:
+            self._frobs.remove(('authorized', frob))
+        else:
+            raise RtmError(101, 'Invalid frob - did you authenticate?')
+        token = '%040x' % self._random.getrandbits(160)
+        self._tokens.add(token)
+        return self._auth(token)
+
+    def checkToken(self, params):
+        self._checkToken(params)
+        return self._auth(params['auth_token'])
+
+    def getLists(self, params):
+        self._checkToken(params)
+        return (u'<lists>' +
+                u''.join(u'<list id="%s" name=%s deleted="0" locked="0" archived="0"'
+                         u' position="-1" smart="0" sort_order="0"/>' %
+                         (record.id, quoteattr(record.name)) for record in self._lists) +
+                u'</lists>')
+
+    def _changeTasks(self):
+        '''
+        Changes some task series, as if they were edited on the web site
+        '''
+        now = self._now()
+        alive = [task for task in self._tasks.values() if task.deleted is None]
+        for task in self._random.sample(alive, min(self.churn, len(alive))):
+            task.modified = now
+            if self._random.random() < 0.1:
+                task.deleted = now
+            else:
+                task.name = task.name.split(u' #')[0] + u' #%d' % self._random.randint(0, 999)
+
+    def getTasks(self, params):
+        self._checkToken(params)
+        self._changeTasks()
+        lastSync = params.get('last_sync')
+        byList = {}
+        for task in self._tasks.values():
+            if lastSync is None and task.deleted is not None:
+                continue
+            if lastSync is not None and task.modified <= lastSync:
+                continue
+            byList.setdefault(task.listId, []).append(task)
+        parts = [u'<tasks rev="%x">' % self._random.getrandbits(64)]
+        for listId in sorted(byList):
+            parts.append(u'<list id="%s">' % listId)
+            deleted = []
+            for task in byList[listId]:
+                if task.deleted is not None:
+                    deleted.append(task)
+                else:
+                    parts.append(self._taskSeriesXml(task))
+            if deleted:
+                parts.append(u'<deleted>')
+                for task in deleted:
+                    parts.append(u'<taskseries id="%s"><task id="%s" deleted="%s"/></taskseries>' %
+                                 (task.taskSeriesId, task.taskId, task.deleted))
+                parts.append(u'</deleted>')
+            parts.append(u'</list>')
+        parts.append(u'</tasks>')
+        return u''.join(parts)
+
+    def _taskSeriesXml(self, task):
+        return (u'<taskseries id="%s" created="%s" modified="%s" name=%s source="api"'
+                u' url="" location_id=""><tags/><participants/><notes/>'
+                u'<task id="%s" due="%s" has_due_time="0" added="%s" completed="%s"'
+                u' deleted="" priority="%s" postponed="0" estimate=""/></taskseries>' %
+                (task.taskSeriesId, task.modified, task.modified, quoteattr(task.name),
+                 task.taskId, task.due, task.modified, task.completed, task.priority))
+
+    def createTimeline(self, params):
+        self._checkToken(params)
+        timeline = str(len(self._timelines) + 1)
+        self._timelines.add(timeline)
+        return u'<timeline>%s</timeline>' % timeline
+
+    def _setCompleted(self, params, completed):
+        self._checkToken(params)
+        if params.get('timeline') not in self._timelines:
+            raise RtmError(300, 'Timeline invalid or not provided')
+        task = self._tasks.get(params.get('taskseries_id'))
+        if task is None or task.deleted is not None or \
+                task.listId != params.get('list_id') or task.taskId != params.get('task_id'):
+            raise RtmError(340, 'list_id/taskseries_id/task_id invalid or not provided')
+        task.completed = completed
+        task.modified = self._now()
+        self._transactions += 1
+        return (u'<transaction id="%d" undoable="1"/><list id="%s">%s</list>' %
+                (self._transactions, task.listId, self._taskSeriesXml(task)))
+
+    def completeTask(self, params):
+        return self._setCompleted(params, self._now())
+
+    def uncompleteTask(self, params):
+        return self._setCompleted(params, u'')
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    # Connections are kept alive, like with the real service
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        options = self.server.options
+        delay = options.latency + random.uniform(0, options.jitter)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+
+        url = urlparse.urlsplit(self.path)
+        params = dict((key.decode('utf-8'), value.decode('utf-8'))
+                      for key, value in urlparse.parse_qsl(url.query, keep_blank_values = True))
+
+        failure = random.random() < options.error_rate
+        if failure and random.random() < 0.5:
+            self._send(503, 'text/plain', 'Service Unavailable')
+            return
+        if url.path.rstrip('/') == '/services/auth':
+            try:
+                self.server.standIn.authorize(params)
+                body = u'<html><body>Application authorized, go back to the lens.</body></html>'
+            except RtmError, e:
+                body = u'<html><body>%s</body></html>' % e.message
+            self._send(200, 'text/html; charset=utf-8', body.encode('utf-8'))
+            return
+        if url.path.rstrip('/') != '/services/rest':
+            self._send(404, 'text/plain', 'Not Found')
+            return
+        try:
+            if failure:
+                raise RtmError(105, 'Service currently unavailable')
+            content = u'<rsp stat="ok">%s</rsp>' % self.server.standIn.call(params)
+        except RtmError, e:
+            content = u'<rsp stat="fail"><err code="%d" msg=%s/></rsp>' % (e.code, quoteattr(e.message))
+        self._send(200, 'text/xml; charset=utf-8',
+                   (u'<?xml version="1.0" encoding="UTF-8"?>' + content).encode('utf-8'))
+
+    def _send(self, status, contentType, body):
+        headers = {'Content-Type': contentType}
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            compressed = StringIO()
+            with gzip.GzipFile(fileobj = compressed, mode = 'wb') as f:
+                f.write(body)
+            body = compressed.getvalue()
+            headers['Content-Encoding'] = 'gzip'
+        headers['Content-Length'] = str(len(body))
+        # send_response adds the Date header, used by the lens as last_sync
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.server.options.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class RtmServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, standIn, options):
+        HTTPServer.__init__(self, address, RequestHandler)
+        self.standIn = standIn
+        self.options = options
+
+
+def parseOptions(args):
+    parser = OptionParser(usage = 'usage: %prog [options]')
+    parser.add_option('--port', type = 'int', default = 8080)
+    parser.add_option('--tasks', type = 'int', default = 1000)
+    parser.add_option('--latency', type = 'float', default = 0)
+    parser.add_option('--jitter', type = 'float', default = 0)
+    parser.add_option('--error-rate', type = 'float', default = 0)
+    parser.add_option('--churn', type = 'int', default = 0)
+    parser.add_option('--api-key', default = LENS_API_KEY)
+    parser.add_option('--secret', default = LENS_SHARED_SECRET)
+    parser.add_option('--token')
+    parser.add_option('--seed', type = 'int', default = 0)
+    parser.add_option('--quiet', action = 'store_true', default = False)
+    options, _ = parser.parse_args(args)
+    return options
+
+
+def main(args):
+    options = parseOptions(args)
+    standIn = RtmStandIn(options.tasks, options.api_key, options.secret,
+                         options.token, options.churn, options.seed)
+    server = RtmServer(('localhost', options.port), standIn, options)
+    print 'RTM stand-in with {} tasks on http://localhost:{}/'.format(options.tasks, options.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,276 @@
+#! /usr/bin/python
+
+#    Copyright (c) 2013 Vincenzo Pii <vinc.pii@gmail.com>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version, with the following additional
+#    restriction:
+#    you cannot modify or redistribute this software if you don't use your
+#    own Remember The Milk API Key and Shared Secret pair, or receive explicit
+#    permission from the author (<vinc.pii@gmail.com>) to include your
+#    changes to the code.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#    This product uses the Remember The Milk API but is not endorsed or
+#    certified by Remember The Milk.
+
+
+
+'''
+Benchmarks of the data layer of the lens (decoding, storage, queries and
+rendering of the tasks), on synthetic accounts of different sizes (see
+fixtures.py).
+
+Usage: python bench/run.py [options]
+    --sizes 1000,10000,100000  number of tasks of the accounts
+    --baselines FILE           results to compare with (bench/baselines.json)
+    --tolerance 0.5            allowed slowdown (0.5 = 50% slower)
+    --update-baselines         store the results as the new baselines
+
+Each size is measured in a separate process, so that its peak memory
+(ru_maxrss) is not affected by the others. The exit status is 1 if any
+measure is worse than its baseline beyond the tolerance, or if searches
+with typos miss too many tasks (see MIN_RECALL).
+'''
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import timeit
+import xml.etree.ElementTree as ElementTree
+from cStringIO import StringIO
+from datetime import timedelta
+from optparse import OptionParser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'src'))
+
+import fixtures
+from rtmapi import RtmObject, parse_response, iter_task_records, iter_list_records
+from TasksDB import TasksDB
+from TaskRenderCache import TaskRenderCache
+from SearchRanker import SearchRanker
+
+BASELINES_FILE = os.path.join(BENCH_DIR, 'baselines.json')
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+# Each measure is the best of REPEAT runs, or of as many runs as fit in
+# MIN_MEASURE_TIME seconds (at most MAX_REPEAT), so that the short ones are
+# not at the mercy of a single busy moment of the machine
+REPEAT = 3
+MIN_MEASURE_TIME = 0.2
+MAX_REPEAT = 50
+
+# Results with this suffix are not timings
+MEMORY_KEY = 'peak_rss_kb'
+
+# Measures faster than this (in seconds) are too noisy to be compared
+MIN_COMPARED_TIME = 0.002
+
+# Results with this prefix are the share of the tasks found by a search with
+# a typo, among those containing the right word (or of the first 100 of
+# them), and must be at least MIN_RECALL
+RECALL_PREFIX = 'recall_'
+MIN_RECALL = 0.9
+
+# Typos searched (a transposition, a missing letter...) -> the right word
+TYPOS = {u'reveiw': u'review', u'flihgt': u'flight', u'mlik': u'milk', u'bok': u'book'}
+
+
+def best(function, repeat = REPEAT):
+    '''
+    Returns the shortest time (in seconds) taken by function
+    '''
+    times = []
+    while len(times) < repeat or (sum(times) < MIN_MEASURE_TIME and len(times) < MAX_REPEAT):
+        start = timeit.default_timer()
+        function()
+        times.append(timeit.default_timer() - start)
+    return min(times)
+
+
+def measure(size):
+    '''
+    Runs the benchmarks for an account with size tasks, returns a
+    dictionary of measure name -> seconds (and the peak memory)
+    '''
+    results = {}
+    tasksXml = fixtures.tasksXml(size)
+    listsXml = fixtures.listsXml(size)
+
+    # Decoding
+    def parseObject():
+        tasks = RtmObject(ElementTree.fromstring(tasksXml), 'rtm.tasks.getList').tasks
+        for taskList in tasks:
+            for taskseries in taskList:
+                taskseries.name
+                taskseries.task.priority
+    results['parse_rtmobject'] = best(parseObject)
+    def parseRecords():
+        tasks = parse_response(tasksXml, 'rtm.tasks.getList').tasks
+        for taskList in tasks:
+            for taskseries in taskList:
+                taskseries.name
+                taskseries.task.priority
+    results['parse_records'] = best(parseRecords)
+    results['parse_stream'] = best(lambda: list(iter_task_records(StringIO(tasksXml))))
+    records = list(iter_task_records(StringIO(tasksXml)))
+    lists = list(iter_list_records(StringIO(listsXml)))
+
+    # Storage
+    response = parse_response(tasksXml, 'rtm.tasks.getList')
+    db = TasksDB()
+    results['store_tasks'] = best(lambda: db.storeTasks(response))
+    results['store_records'] = best(lambda: db.storeTaskRecords(iter(records)))
+    db.storeListRecords(lists)
+    delta = [record._replace(name = record.name + u' changed') for record in records[::20]]
+    results['merge_delta'] = best(lambda: db.mergeTaskRecords(delta))
+
+    # Queries, each one reading the database
+    db.QUERY_CACHE_SIZE = 0
+    category = fixtures.listName(0)
+    for orderBy in (TasksDB.TPRIORITY, TasksDB.TDUE, TasksDB.TNAME):
+        for showCompleted in (False, True):
+            name = 'get_tasks_%s%s' % (orderBy, '_completed' if showCompleted else '')
+            results[name] = best(lambda: db.getTasks(None, orderBy, showCompleted))
+        results['get_tasks_%s_category' % orderBy] = \
+            best(lambda: db.getTasks(category, orderBy, False))
+    results['get_tasks_search'] = best(lambda: db.getTasks(None, TasksDB.TPRIORITY, False, u'repo'))
+    results['get_tasks_search_words'] = best(lambda: db.getTasks(None, TasksDB.TPRIORITY, False, u'caf rev'))
+    results['get_fuzzy_tasks'] = best(lambda: db.getFuzzyTasks(None, False, u'reveiw', 200))
+    # First page of the results without phrase (see Meta.search_first_page)
+    results['get_tasks_first_page'] = best(lambda: db.getTasks(None, TasksDB.TPRIORITY, False, limit = 60))
+    db.QUERY_CACHE_SIZE = TasksDB.QUERY_CACHE_SIZE
+    db.getTasks(None, TasksDB.TPRIORITY, False)
+    results['get_tasks_cached'] = best(lambda: db.getTasks(None, TasksDB.TPRIORITY, False))
+
+    # Rendering of every task (the cache is empty the first time only)
+    tasks = db.getTasks(None, TasksDB.TPRIORITY, True)
+    renderCache = TaskRenderCache('icon', '.png', timedelta(hours = 2))
+    def render():
+        renderCache.invalidate()
+        for task in tasks:
+            renderCache.get(task)
+    results['render_rows'] = best(render)
+    results['render_rows_cached'] = best(lambda: [renderCache.get(task) for task in tasks])
+
+    # Ranking of the results of a common word and of a typo
+    ranker = SearchRanker()
+    for name, phrase in (('rank_search', u'book'), ('rank_fuzzy', u'reveiw')):
+        exact = [(task, renderCache.get(task)) for task in db.getTasks(None, TasksDB.TPRIORITY, False, phrase)]
+        fuzzy = [(task, renderCache.get(task)) for task in db.getFuzzyTasks(None, False, phrase, 200)]
+        words = TasksDB.searchTokens(phrase)
+        results[name] = best(lambda: ranker.rank(words, exact, fuzzy, 100, time.time()))
+
+    # Recall of the searches with typos, ranked like the lens does
+    for typo, word in sorted(TYPOS.items()):
+        expected = [task for task in db.getTasks(None, TasksDB.TPRIORITY, False, word)
+                    if word in renderCache.get(task).searchTokens]
+        exact = [(task, renderCache.get(task)) for task in db.getTasks(None, TasksDB.TPRIORITY, False, typo)]
+        fuzzy = [(task, renderCache.get(task)) for task in db.getFuzzyTasks(None, False, typo, 200)]
+        ranked = ranker.rank(TasksDB.searchTokens(typo), exact, fuzzy, 100, time.time())
+        found = len([rendered for task, rendered in ranked if word in rendered.searchTokens])
+        results[RECALL_PREFIX + typo] = float(found) / max(min(len(expected), 100), 1)
+
+    # ru_maxrss is in kilobytes on Linux
+    results[MEMORY_KEY] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+
+def measureInProcess(size):
+    '''
+    Runs measure(size) in a new process
+    '''
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                      '--child', str(size)])
+    return json.loads(output)
+
+
+def compare(size, results, baselines, tolerance):
+    '''
+    Prints the results of a size next to the baselines, returns the names
+    of the measures that got worse (or the recalls below MIN_RECALL)
+    '''
+    worse = []
+    baseline = baselines.get(str(size), {})
+    print '{} tasks'.format(size)
+    for name in sorted(results):
+        value = results[name]
+        reference = baseline.get(name)
+        if name.startswith(RECALL_PREFIX):
+            line = '  {:<32} {:>10.2f}'.format(name, value)
+            if value < MIN_RECALL:
+                line += '  LOW RECALL'
+                worse.append(name)
+            print line
+            continue
+        if name == MEMORY_KEY:
+            line = '  {:<32} {:>10d} KB'.format(name, value)
+        else:
+            line = '  {:<32} {:>10.4f} s'.format(name, value)
+        if reference:
+            ratio = float(value) / reference
+            line += '  {:>+7.1%}'.format(ratio - 1)
+            if ratio > 1 + tolerance and (name == MEMORY_KEY or value > MIN_COMPARED_TIME):
+                line += '  REGRESSION'
+                worse.append(name)
+        print line
+    return worse
+
+
+def main():
+    parser = OptionParser(usage = 'usage: %prog [options]')
+    parser.add_option('--sizes', default = ','.join(str(size) for size in DEFAULT_SIZES))
+    parser.add_option('--baselines', default = BASELINES_FILE)
+    parser.add_option('--tolerance', type = 'float', default = 0.5)
+    parser.add_option('--update-baselines', action = 'store_true', default = False)
+    parser.add_option('--child', type = 'int', help = 'internal: measure one size')
+    options, _ = parser.parse_args()
+
+    if options.child is not None:
+        # The output is for the results only, diagnostics go to stderr
+        stdout, sys.stdout = sys.stdout, sys.stderr
+        results = measure(options.child)
+        json.dump(results, stdout)
+        return 0
+
+    try:
+        with open(options.baselines) as f:
+            baselines = json.load(f)
+    except IOError:
+        baselines = {}
+
+    regressions = []
+    for size in [int(size) for size in options.sizes.split(',')]:
+        results = measureInProcess(size)
+        regressions += ['{}:{}'.format(size, name)
+                        for name in compare(size, results, baselines, options.tolerance)]
+        if options.update_baselines:
+            baselines[str(size)] = results
+
+    if options.update_baselines:
+        with open(options.baselines, 'w') as f:
+            json.dump(baselines, f, indent = 2, sort_keys = True)
+        print 'Baselines stored in {}'.format(options.baselines)
+        return 0
+    if regressions:
+        print 'Performance regressions: {}'.format(', '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
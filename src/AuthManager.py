@@ -23,18 +23,45 @@
 #    This product uses the Remember The Milk API but is not endorsed or
 #    certified by Remember The Milk.
 
+from rtmapi import RtmException
+from time import time
 import webbrowser
 
 class AuthManager(object):
     '''
     This class handles the RTM authentication process
     '''
-    def __init__(self, icon, taskModelItem):
+
+    # Time after which a valid token is checked again with RTM (in seconds)
+    TOKEN_VALIDATION_TTL = 3600
+
+    # Time after which a token that could not be checked (RTM unreachable
+    # or not working properly) is checked again (in seconds)
+    TOKEN_VALIDATION_RETRY = 300
+
+    # RTM error codes meaning that the token is not valid (anymore)
+    # See http://www.rememberthemilk.com/services/api/response.rtm
+    AUTH_ERROR_CODES = ('98',)
+
+    def __init__(self, icon, taskModelItem, tokenValidationTtl = TOKEN_VALIDATION_TTL,
+                 tokenValidationRetry = TOKEN_VALIDATION_RETRY):
         super(AuthManager, self).__init__()
 
         # Authentication process state
         self._authReqPending = False
 
+        # Time after which a valid token is checked again with RTM
+        self._tokenValidationTtl = tokenValidationTtl
+        self._tokenValidationRetry = tokenValidationRetry
+
+        # Last token validated by RTM (or assumed valid because RTM could
+        # not be asked) and the time after which it is checked again
+        self._validatedToken = None
+        self._validationExpiry = 0
+
+        # Last token rejected by RTM
+        self._rejectedToken = None
+
         # Icon to display
         self._icon = icon
 
@@ -48,11 +75,62 @@ class AuthManager(object):
         return True
     
     def _isAuthNeeded(self, rtmApi):
-        if rtmApi.token_valid() and self._authReqPending == False:
+        if self._authReqPending == False and self._isTokenValid(rtmApi):
             return False
         else:
             return True
 
+    def _isTokenValid(self, rtmApi):
+        '''
+        Returns True if the token is valid. RTM is asked only when the last
+        validation is older than the TTL; if it can't be reached, the last
+        known state of the token is used, and RTM is asked again after the
+        retry interval only (not by every search).
+        '''
+        token = rtmApi.token
+        if token is None or token == self._rejectedToken:
+            return False
+        if token == self._validatedToken and time() < self._validationExpiry:
+            return True
+        try:
+            # See http://www.rememberthemilk.com/services/api/methods/rtm.auth.checkToken.rtm
+            rtmApi.rtm.auth.checkToken()
+        except RtmException, e:
+            if self.invalidateOnAuthError(rtmApi, e):
+                return False
+            # RTM is not working properly, don't blame the token
+            print "Unable to check the token: ", e
+            self._assumeValid(token, self._tokenValidationRetry)
+            return True
+        except Exception, e:
+            # Offline: a token that was never rejected is still good (it
+            # was valid when it was saved)
+            print "Unable to check the token: ", e
+            self._assumeValid(token, self._tokenValidationRetry)
+            return True
+        self._assumeValid(token, self._tokenValidationTtl)
+        return True
+
+    def _assumeValid(self, token, interval):
+        '''
+        The token is considered valid for the next interval seconds
+        '''
+        self._validatedToken = token
+        self._validationExpiry = time() + interval
+
+    def invalidateOnAuthError(self, rtmApi, exception):
+        '''
+        To be called when an authenticated RTM call fails: if the failure is
+        an authentication error, the current token is not used anymore.
+        Returns True if the token has been invalidated.
+        '''
+        if not isinstance(exception, RtmException) or \
+                exception.code not in self.AUTH_ERROR_CODES:
+            return False
+        self._rejectedToken = rtmApi.token
+        self._validatedToken = None
+        return True
+
     def _rtmRequireAuthentication(self, rtmApi, model):
         """
         Open the Web Browser to let the user authenticate
@@ -91,6 +169,8 @@ class AuthManager(object):
         token = rtmApi.token
         # Signal that the auth process has finished
         self._authReqPending = False
+        # The new token is checked on the next search
+        self._validatedToken = None
 
         # If the token is valid, store it to a file
         if token is not None:
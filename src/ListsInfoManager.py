@@ -24,17 +24,14 @@
 #    certified by Remember The Milk.
 
 
-from rtmapi import Rtm
-
-from TokenManager import TokenManager
-
 class ListsInfoManager(object):
     '''
-    This class retrieves lists information from the RTM service.
+    This class provides the lists information stored in the database
+    (downloaded from the RTM service with the tasks, see
+    TasksInfoManager.downloadTasksList).
 
     It has the following responsibilities:
         * Provide the <listid, listname> mappings
-        * Provide the list of listnames in a static manner
     '''
 
     def __init__(self):
@@ -47,28 +44,18 @@ class ListsInfoManager(object):
         # Object to translate from list name to list id
         self._reverseListsDictionary = {}
 
-        # Full representation of the RTM lists xml object
-        self._rtmListsRepresentation = None
-
-    def _getTheRtmListsRepresentation(self, rtmApi):
+    def buildTheListsDictionary(self, db):
         '''
-        Queries the RTM service to get the lists xml representation 
+        This method reads the lists stored in the database (no request is
+        made to the RTM service) and builds the <listId, listName>
+        dictionary again
         '''
-        if self._rtmListsRepresentation != None:
-            return
-        # Get the lists, see http://www.rememberthemilk.com/services/api/methods/rtm.lists.getList.rtm
-        self._rtmListsRepresentation = rtmApi.rtm.lists.getList()
-    
-    def buildTheListsDictionary(self, rtmApi):
-        '''
-        This method downloads the lists information from the RTM service
-        and builds the <listId, listName> dictionary
-        '''
-        self._getTheRtmListsRepresentation(rtmApi)
+        self._listsDictionary = {}
+        self._reverseListsDictionary = {}
         # build the internal representation of categories
-        for element in self._rtmListsRepresentation.lists:
-            self._listsDictionary[element.id] = element.name
-            self._reverseListsDictionary[element.name] = element.id
+        for record in db.getLists():
+            self._listsDictionary[record.id] = record.name
+            self._reverseListsDictionary[record.name] = record.id
 
     def getListName(self, listId):
         '''
@@ -89,29 +76,3 @@ class ListsInfoManager(object):
         except KeyError:
             raise KeyError
         return listId
-
-    @staticmethod
-    def getTheCategoriesListStatically(apiKey, sharedSecret):
-        '''
-        This method uses the RTM service by instantiating a new RTM object
-        and tries to retrieve the list of listnames from the service.
-        It can be run independently, as it uses an extra instance of the
-        RTM object
-        '''
-        listsNames = []
-        tokenManager = TokenManager()
-        token = tokenManager.readTokenFromFile()
-        if (token is None):
-            # If the token doesn't exist, it won't work
-            return listsNames
-        rtm = Rtm(apiKey, sharedSecret, "read", token)
-        if not rtm.token_valid():
-            # The token wasn't vaid
-            return listsNames
-        # Get the lists description, see http://www.rememberthemilk.com/services/api/methods/rtm.lists.getList.rtm
-        listsList = rtm.rtm.lists.getList()
-        # Get the name of each list
-        for element in listsList.lists:
-            listsNames.append(element.name)
-        return listsNames
-
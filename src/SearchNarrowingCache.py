@@ -0,0 +1,113 @@
+#! /usr/bin/python
+
+#    Copyright (c) 2013 Vincenzo Pii <vinc.pii@gmail.com>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version, with the following additional
+#    restriction:
+#    you cannot modify or redistribute this software if you don't use your
+#    own Remember The Milk API Key and Shared Secret pair, or receive explicit
+#    permission from the author (<vinc.pii@gmail.com>) to include your
+#    changes to the code.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#    This product uses the Remember The Milk API but is not endorsed or
+#    certified by Remember The Milk.
+
+
+
+import threading
+
+class SearchNarrowingCache(object):
+    '''
+    This class keeps the results of the last searches made while the user
+    types, so that a longer phrase filters the results of a shorter one
+    instead of querying the database again.
+
+    The results are kept for a single state of the filters (category,
+    ordering, completed tasks...) and of the database generation (see
+    TasksDB.generation), in a stack of phrases each extending the previous
+    one: deleting characters finds the results of the shorter phrases on
+    the stack.
+
+    Results are lists of (task dictionary, RenderedTask) tuples.
+    '''
+
+    # Maximum number of phrases kept
+    STACK_SIZE = 16
+
+    def __init__(self):
+        super(SearchNarrowingCache, self).__init__()
+
+        # Filters state and database generation of the stack
+        self._key = None
+
+        # (phrase, words, results) tuples, each phrase extending the previous
+        self._stack = []
+
+        # Searches may run in different threads at the same time
+        self._lock = threading.Lock()
+
+    def lookup(self, key, phrase, words):
+        '''
+        Returns the results for the phrase (None for all the tasks) or
+        None if they must be read from the database.
+
+        words are the words that the task names must contain, as returned by
+        TasksDB.searchWords: when they are None, the results can only be
+        found if the phrase is on the stack.
+        '''
+        phrase = phrase or u''
+        with self._lock:
+            if key != self._key:
+                self._key = key
+                self._stack = []
+                return None
+            # Drop the phrases that are not the beginning of this one
+            while len(self._stack) > 0 and not phrase.startswith(self._stack[-1][0]):
+                self._stack.pop()
+            if len(self._stack) == 0:
+                return None
+            lastPhrase, lastWords, results = self._stack[-1]
+            if lastPhrase == phrase:
+                return results
+            if words is None or (lastWords is None and lastPhrase != u''):
+                return None
+        # Every word of a shorter phrase is the beginning of a word of the
+        # longer one, so its results contain the new ones
+        return [result for result in results if self._matches(result[1].searchTokens, words)]
+
+    def _matches(self, tokens, words):
+        for word in words:
+            for token in tokens:
+                if token.startswith(word):
+                    break
+            else:
+                return False
+        return True
+
+    def store(self, key, phrase, words, results):
+        '''
+        Adds the results of a phrase to the stack
+        '''
+        phrase = phrase or u''
+        with self._lock:
+            if key != self._key:
+                self._key = key
+                self._stack = []
+            while len(self._stack) > 0 and not phrase.startswith(self._stack[-1][0]):
+                self._stack.pop()
+            if len(self._stack) > 0 and self._stack[-1][0] == phrase:
+                return
+            self._stack.append((phrase, words, results))
+            if len(self._stack) > self.STACK_SIZE:
+                del self._stack[0]
@@ -0,0 +1,206 @@
+#! /usr/bin/python
+
+#    Copyright (c) 2013 Vincenzo Pii <vinc.pii@gmail.com>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version, with the following additional
+#    restriction:
+#    you cannot modify or redistribute this software if you don't use your
+#    own Remember The Milk API Key and Shared Secret pair, or receive explicit
+#    permission from the author (<vinc.pii@gmail.com>) to include your
+#    changes to the code.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#    This product uses the Remember The Milk API but is not endorsed or
+#    certified by Remember The Milk.
+
+
+
+from calendar import timegm
+import heapq
+from time import strptime
+from TasksDB import TasksDB
+
+class SearchRanker(object):
+    '''
+    This class orders the results of a search and keeps the best ones only.
+
+    The score adds up how well the task name matches the words of the
+    phrase, the priority of the task and how close its due date is. When
+    an ordering is chosen, results are ordered by how well they match the
+    phrase first (in bands, see QUALITY_BANDS), then in the chosen order,
+    then by score.
+
+    The results matching the phrase are completed by fuzzy ones (see
+    TasksDB.getFuzzyTasks), kept only if each word of the phrase is
+    similar enough to a word of the name, or one typo away from it (a
+    letter added, removed, replaced or two adjacent ones swapped), so that
+    typos still find the tasks. Fuzzy results match worse than exact ones.
+
+    Results are (task dictionary, RenderedTask) tuples.
+    '''
+
+    # Weight of the match quality (1 at most) in the score
+    MATCH_WEIGHT = 4.0
+
+    # Quality of the words matching a whole word of the name, the beginning
+    # of one, and of the results not matching word by word (e.g. found with
+    # a substring search)
+    WORD_QUALITY = 1.0
+    PREFIX_QUALITY = 0.9
+    EXACT_MIN_QUALITY = 0.8
+
+    # Similarity (Dice coefficient of the trigrams) needed by the words of
+    # fuzzy results, and the quality of a word as similar as possible
+    FUZZY_MIN_SIMILARITY = 0.35
+    FUZZY_QUALITY = 0.5
+
+    # Words shorter than this share too few trigrams with the right word
+    # when mistyped, they are accepted one typo away from it instead, with
+    # the similarity of the letters in the right place
+    TYPO_MIN_LENGTH = 3
+
+    # Number of bands of match quality within which the chosen ordering
+    # applies: a whole word match always comes before a prefix one, and an
+    # exact one before a fuzzy one
+    QUALITY_BANDS = 10
+
+    # Score of each priority
+    PRIORITY_SCORES = {'1': 1.0, '2': 0.6, '3': 0.3}
+
+    # Score of the overdue tasks and of those due now, tasks due later
+    # score less every day
+    DUE_SCORE = 1.0
+
+    def __init__(self):
+        super(SearchRanker, self).__init__()
+
+        # Due date (as stored in the database) -> seconds since the epoch
+        self._dueTimes = {}
+
+    def rank(self, words, results, fuzzyResults, limit, now, orderBy = None):
+        '''
+        Returns the best limit results, best first, among results (which
+        match the search) and fuzzyResults (which are kept only if similar
+        enough). Results that compare equal keep their order.
+
+        words are the words of the phrase as returned by
+        TasksDB.searchTokens, now is the time (seconds since the epoch) the
+        due dates are compared to, orderBy the task dictionary key of the
+        chosen ordering (see TasksDB.getTasks) or None.
+        '''
+        trigrams = dict((word, self.trigrams(word)) for word in words)
+
+        def entries():
+            index = 0
+            for fuzzy, candidates in ((False, results), (True, fuzzyResults)):
+                for result in candidates:
+                    quality = self.matchQuality(words, trigrams, result[1].searchTokens, fuzzy)
+                    if quality is None:
+                        continue
+                    if not fuzzy:
+                        quality = max(quality, self.EXACT_MIN_QUALITY)
+                    taskDictionary = result[0]
+                    score = (self.MATCH_WEIGHT * quality +
+                             self.PRIORITY_SCORES.get(taskDictionary[TasksDB.TPRIORITY], 0.0) +
+                             self.dueScore(taskDictionary[TasksDB.TDUE], now))
+                    # Earlier results win ties
+                    if orderBy is None:
+                        key = (-score, index)
+                    else:
+                        band = int(quality * self.QUALITY_BANDS + 1e-9)
+                        key = (-band, taskDictionary[orderBy], -score, index)
+                    index += 1
+                    yield key, result
+
+        return [result for key, result in heapq.nsmallest(limit, entries(), key = lambda entry: entry[0])]
+
+    def matchQuality(self, words, trigrams, tokens, fuzzy):
+        '''
+        Returns the average quality of the words of the phrase in the task
+        name (split in tokens), or None if fuzzy and a word is not similar
+        enough to any token
+        '''
+        if len(words) == 0:
+            return self.WORD_QUALITY
+        total = 0.0
+        for word in words:
+            best = 0.0
+            for token in tokens:
+                if token == word:
+                    best = self.WORD_QUALITY
+                    break
+                if token.startswith(word):
+                    best = self.PREFIX_QUALITY
+                elif fuzzy and best < self.PREFIX_QUALITY:
+                    similarity = self.similarity(trigrams[word], self.trigrams(token))
+                    if len(word) >= self.TYPO_MIN_LENGTH and (self.oneTypo(word, token) or
+                                                             self.oneTypo(word, token[:len(word)])):
+                        similarity = max(similarity, 1.0 - 1.0 / len(word))
+                    if similarity >= self.FUZZY_MIN_SIMILARITY:
+                        best = max(best, similarity * self.FUZZY_QUALITY)
+            if fuzzy and best == 0.0:
+                return None
+            total += best
+        return total / len(words)
+
+    def dueScore(self, due, now):
+        '''
+        Returns the score of a due date as stored in the database (empty
+        or None for tasks without due date)
+        '''
+        if not due:
+            return 0.0
+        dueTime = self._dueTimes.get(due)
+        if dueTime is None:
+            dueTime = timegm(strptime(due, '%Y-%m-%dT%H:%M:%SZ'))
+            self._dueTimes[due] = dueTime
+        days = (dueTime - now) / 86400.0
+        if days <= 0:
+            return self.DUE_SCORE
+        return self.DUE_SCORE / (1 + days)
+
+    @staticmethod
+    def oneTypo(word, other):
+        '''
+        Returns True if other is word with one letter added, removed or
+        replaced, or with two adjacent letters swapped
+        '''
+        if len(word) > len(other):
+            word, other = other, word
+        if len(other) - len(word) > 1 or word == other:
+            return False
+        i = 0
+        while i < len(word) and word[i] == other[i]:
+            i += 1
+        if len(word) < len(other):
+            return word[i:] == other[i + 1:]
+        if word[i + 1:] == other[i + 1:]:
+            return True
+        return (i + 1 < len(word) and word[i] == other[i + 1] and word[i + 1] == other[i] and
+                word[i + 2:] == other[i + 2:])
+
+    @staticmethod
+    def trigrams(word):
+        '''
+        Returns the set of the trigrams of a word, padded with spaces so
+        that the short words have some
+        '''
+        padded = u' ' + word + u' '
+        return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+    @staticmethod
+    def similarity(trigrams, otherTrigrams):
+        '''
+        Dice coefficient of two sets of trigrams
+        '''
+        return 2.0 * len(trigrams & otherTrigrams) / (len(trigrams) + len(otherTrigrams))
@@ -0,0 +1,149 @@
+#! /usr/bin/python
+
+#    Copyright (c) 2013 Vincenzo Pii <vinc.pii@gmail.com>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version, with the following additional
+#    restriction:
+#    you cannot modify or redistribute this software if you don't use your
+#    own Remember The Milk API Key and Shared Secret pair, or receive explicit
+#    permission from the author (<vinc.pii@gmail.com>) to include your
+#    changes to the code.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#    This product uses the Remember The Milk API but is not endorsed or
+#    certified by Remember The Milk.
+
+
+from datetime import datetime
+from TasksDB import TasksDB
+
+class RenderedTask(object):
+    '''
+    What is displayed for a task, computed once
+    '''
+    __slots__ = ('source', 'uri', 'dueText', 'dueLabel', 'icon', 'plainIcon', 'searchTokens')
+
+
+class TaskRenderCache(object):
+    '''
+    This class computes and caches the strings used to display tasks
+    (result URI, formatted due date, icons...), so that they are not
+    computed again for every search.
+
+    Entries are kept by task series (the database stores one task for each
+    series) and are computed again when the task changes.
+    '''
+
+    # URI of the result displaying a task
+    TASK_URI_FORMAT = 'rtmLens://select/lid={}&tsid={}&tid={}'
+
+    def __init__(self, iconPrefix, iconExtension, tzoffset):
+        super(TaskRenderCache, self).__init__()
+
+        # Icons are iconPrefix + ('u' or 'c') + 'p' + priority + iconExtension
+        self._iconPrefix = iconPrefix
+        self._iconExtension = iconExtension
+
+        # The user's current system timezone offset
+        self._tzoffset = tzoffset
+
+        # Task series id -> RenderedTask
+        self._entries = {}
+
+    def get(self, taskDictionary):
+        '''
+        Returns the RenderedTask for a task, as returned by TasksDB.getTasks
+        '''
+        source = (taskDictionary[TasksDB.TLIST_ID],
+                  taskDictionary[TasksDB.TID],
+                  taskDictionary[TasksDB.TNAME],
+                  taskDictionary[TasksDB.TDUE],
+                  taskDictionary[TasksDB.TPRIORITY],
+                  taskDictionary[TasksDB.TCOMPLETED])
+        taskSeriesId = taskDictionary[TasksDB.TSERIES_ID]
+        rendered = self._entries.get(taskSeriesId)
+        if rendered is None or rendered.source != source:
+            rendered = self._render(taskSeriesId, source)
+            self._entries[taskSeriesId] = rendered
+        return rendered
+
+    def _render(self, taskSeriesId, source):
+        listId, taskId, name, due, priority, completed = source
+        rendered = RenderedTask()
+        rendered.source = source
+        rendered.uri = self.TASK_URI_FORMAT.format(listId, taskSeriesId, taskId)
+        rendered.dueText = self.formatDueDate(due)
+        rendered.dueLabel = ' [' + rendered.dueText + ']' if len(rendered.dueText) > 0 else ''
+        rendered.icon = self.iconForTask(priority, completed)
+        rendered.plainIcon = self.iconForTask('N', completed)
+        rendered.searchTokens = TasksDB.searchTokens(name)
+        return rendered
+
+    def invalidate(self, taskSeriesIds = None):
+        '''
+        Drops the entries of the given task series (all of them if None)
+        '''
+        if taskSeriesIds is None:
+            self._entries = {}
+            return
+        for taskSeriesId in taskSeriesIds:
+            self._entries.pop(taskSeriesId, None)
+
+    def iconForTask(self, priority, completed):
+        '''
+        Returns the file name of the icon to be used for the task with a
+        given priority and complete status
+        '''
+        if completed == u'':
+            # not completed
+            completed = 'u'
+        else:
+            # completed
+            completed = 'c'
+
+        icon = self._iconPrefix + completed + 'p' + priority + self._iconExtension
+        return icon
+
+    def formatDueDate(self, dueDateString):
+        '''
+        Parses the due date as provided by the service and
+        produces a pretty representation
+        '''
+        if dueDateString == '':
+            return ''
+
+        # Input format example: 2012-03-29T22:00:00Z
+
+        # Collect the tokens
+        start = 0;
+        firstHyphen = dueDateString.find('-')
+        secondHyphen = dueDateString.rfind('-')
+        bigT = dueDateString.find('T')
+        firstColon = dueDateString.find(':')
+        secondColon = dueDateString.rfind(':')
+        bigZ =  dueDateString.find('Z')
+
+        # Extract the strings
+        year = dueDateString[start : firstHyphen]
+        month = dueDateString[firstHyphen + 1 : secondHyphen]
+        day = dueDateString[secondHyphen + 1 : bigT]
+        hour = dueDateString[bigT + 1 : firstColon]
+        minutes = dueDateString[firstColon + 1 : secondColon]
+        seconds = dueDateString[secondColon + 1 : bigZ]
+
+        # Build the formatted string
+        dt = datetime (int(year), int(month), int(day), int(hour), int(minutes), int(seconds))
+        dt = dt + self._tzoffset
+
+        # E.g. 'Wed 07 Nov 2012 11:09AM'
+        return dt.strftime("%a %d %b %Y %I:%M%p")
@@ -23,7 +23,27 @@
 #    This product uses the Remember The Milk API but is not endorsed or
 #    certified by Remember The Milk.
 
+import os
+import re
 import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import time
+from rtmapi import TaskRecord, ListRecord
+
+def _synchronized(method):
+    '''
+    Decorator serializing the calls to a TasksDB method, as the database is
+    accessed both by searches and by downloads running in other threads
+    '''
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
 
 class TasksDB(object):
     """
@@ -37,6 +57,42 @@ class TasksDB(object):
 
     TASKS_TABLE_NAME = 'tasks'
     LISTS_TABLE_NAME = 'lists'
+    SYNC_TABLE_NAME = 'sync'
+    # Full text index on the names of the tasks
+    TASKS_INDEX_NAME = 'tasks_fts'
+    # Index of the trigrams of the names of the tasks, for fuzzy searches
+    TRIGRAM_INDEX_NAME = 'tasks_trigram'
+
+    # File for the persistent database (next to the token file)
+    DB_FILE = os.getenv('HOME') + "/.config/remember-the-lens/tasks.db"
+
+    # Version of the database schema, stored as user_version in the
+    # database file. Must be increased every time the schema changes, adding
+    # the migration from the previous version to _migrations.
+    SCHEMA_VERSION = 7
+
+    # Schema version -> name of the method upgrading a database from that
+    # version to the next one. Databases that can't be upgraded are rebuilt.
+    _migrations = {4: '_migrateFrom4', 5: '_migrateFrom5', 6: '_migrateFrom6'}
+
+    # Number of columns of each table, for bulk inserts
+    _columnsCount = {TASKS_TABLE_NAME: 7, LISTS_TABLE_NAME: 2}
+
+    # Number of records of a tasks delta merged with the same statements
+    MERGE_BATCH_SIZE = 500
+
+    # Maximum number of getTasks results kept in memory
+    QUERY_CACHE_SIZE = 32
+
+    # Columns by which getTasks can order the tasks (each one is indexed)
+    _orderings = ('priority', 'due', 'name')
+
+    # Words of a search phrase
+    WORDS_RE = re.compile(r'\w+', re.UNICODE)
+
+    # Tokens of the full text index (the default unicode61 tokenizer splits
+    # on anything that is not a letter or a digit)
+    TOKENS_RE = re.compile(r'[^\W_]+', re.UNICODE)
     
     # List of keys to dictionaries describing a task, for easy access by external modules
     TNAME = "name"
@@ -49,13 +105,41 @@ class TasksDB(object):
     TCATEGORY = "listname"
     
 
-    def __init__(self):
+    def __init__(self, dbFile = None):
+        '''
+        If dbFile is None, the database is kept in memory, otherwise it is
+        stored in the given file and survives restarts of the lens.
+        '''
         super(TasksDB, self).__init__()
         
         self.NAMED_DB = 'memorydb'
         
         # Connection to SqLite DB
         self._dbconn = None
+
+        # Lock for the connection, shared by different threads
+        self._lock = threading.RLock()
+
+        # Statistics about the last bulk insert, see _bulkInsert
+        self.lastIngestStats = None
+
+        # Function called with lastIngestStats after every bulk insert
+        # (e.g. Timings.ingestObserver)
+        self.ingestObserver = None
+
+        # Functions called when the stored tasks change, see addChangeListener
+        self._changeListeners = []
+
+        # Increased every time the stored tasks or lists change, so that
+        # results computed from them can be recognized as outdated
+        self.generation = 0
+
+        # Results of the last getTasks calls (arguments -> tasks), least
+        # recently used first, for the current generation
+        self._queryCache = OrderedDict()
+        self._queryCacheGeneration = 0
+        self._queryCacheHits = 0
+        self._queryCacheMisses = 0
         
         # Keys to dictionaries describing tasks returned when the DB is queried
         # If a new item must be returned for a task, just add the corresponding
@@ -63,20 +147,166 @@ class TasksDB(object):
         # e.g.: this will only get task name and id: self.columns = [self.TID, self.TNAME]
         self.columns = [self.TLIST_ID, self.TSERIES_ID, self.TID, self.TNAME, self.TDUE, self.TPRIORITY, self.TCOMPLETED, self.TCATEGORY]
 
-        # In memory database with a name so it can be shared
-        self._dbconn = sqlite3.connect(':memory:')
-        self._createTasksTable()
-        self._createListsTable()
+        if dbFile is None:
+            # In memory database
+            self._dbconn = sqlite3.connect(':memory:', check_same_thread = False,
+                                           isolation_level = None)
+        else:
+            self._dbconn = self._openDatabaseFile(os.path.expanduser(dbFile))
+
+        # Rows replaced because of unique indexes must be removed from the
+        # full text index too
+        self._dbconn.execute('PRAGMA recursive_triggers=ON')
+
+        # Text of the names in the trigram index (see _searchText)
+        self._dbconn.create_function('searchtext', 1, self._searchText)
+
+        self._migrateSchema()
+
+        # The full text index requires the FTS5 extension, without it task
+        # names are searched with LIKE
+        self._indexEnabled = self._tableExists(self.TASKS_INDEX_NAME)
+
+        # The trigram index requires the trigram tokenizer (SQLite 3.34),
+        # without it there are no fuzzy searches
+        self._trigramEnabled = self._tableExists(self.TRIGRAM_INDEX_NAME)
 
     def close(self, exc_type, exc_info, exc_tb):
         self._dbconn.close()
 
+    def _openDatabaseFile(self, dbFile):
+        '''
+        Opens (or creates) the database stored in dbFile
+        '''
+        dbFolder = os.path.dirname(dbFile)
+        if not os.path.exists(dbFolder):
+            os.makedirs(dbFolder)
+        try:
+            dbconn = sqlite3.connect(dbFile, check_same_thread = False,
+                                     isolation_level = None)
+            dbconn.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.DatabaseError:
+            # Not a valid database file, start from scratch
+            os.remove(dbFile)
+            dbconn = sqlite3.connect(dbFile, check_same_thread = False,
+                                     isolation_level = None)
+            dbconn.execute('PRAGMA journal_mode=WAL')
+        # Losing the last transactions on power loss is fine for a cache
+        dbconn.execute('PRAGMA synchronous=NORMAL')
+        return dbconn
+
+    @contextmanager
+    def _transaction(self):
+        '''
+        Runs the statements of the with block in a single transaction (the
+        connection is in autocommit mode), which is rolled back if the
+        block raises an exception
+        '''
+        self._dbconn.execute('begin')
+        try:
+            yield self._dbconn.cursor()
+        except:
+            self._dbconn.execute('rollback')
+            raise
+        self._dbconn.execute('commit')
+
+    def _getSchemaVersion(self):
+        return self._dbconn.execute('PRAGMA user_version').fetchone()[0]
+
+    def _setSchemaVersion(self, version):
+        self._dbconn.execute('PRAGMA user_version=%d' % version)
+
+    def _migrateSchema(self):
+        '''
+        Brings the database to the current schema version, applying the
+        migrations in order in a single transaction
+        '''
+        version = self._getSchemaVersion()
+        if version == self.SCHEMA_VERSION:
+            return
+        with self._transaction():
+            while version in self._migrations:
+                print "Migrating the database from version {}".format(version)
+                getattr(self, self._migrations[version])()
+                version += 1
+            if version != self.SCHEMA_VERSION:
+                # The cached data can always be downloaded again, so a
+                # database that can't be migrated is simply rebuilt
+                self._dropTables()
+                self._createTasksTable()
+                self._createListsTable()
+                self._createSyncTable()
+                self._createTasksIndex()
+                self._createTrigramIndex()
+            self._setSchemaVersion(self.SCHEMA_VERSION)
+
+    def _migrateFrom4(self):
+        '''
+        Version 5 adds the primary keys and the indexes for the orderings
+        '''
+        cursor = self._dbconn.cursor()
+        # The primary keys can only be added by copying the tables. The
+        # rowids are kept, as the full text index refers to them.
+        cursor.execute('alter table ' + self.TASKS_TABLE_NAME + ' rename to old_tasks')
+        cursor.execute('drop index if exists tasks_taskseriesid')
+        cursor.execute('drop index if exists tasks_ids')
+        self._createTasksTable()
+        cursor.execute('insert or replace into ' + self.TASKS_TABLE_NAME +
+                       ' (rowid, listid, taskseriesid, taskid, completed, name, due, priority)' +
+                       ' select rowid, listid, taskseriesid, taskid, completed, name, due, priority' +
+                       ' from old_tasks')
+        cursor.execute('drop table old_tasks')
+        cursor.execute('alter table ' + self.LISTS_TABLE_NAME + ' rename to old_lists')
+        self._createListsTable()
+        cursor.execute('insert or replace into ' + self.LISTS_TABLE_NAME +
+                       ' (rowid, listid, listname) select rowid, listid, listname from old_lists')
+        cursor.execute('drop table old_lists')
+        if self._tableExists(self.TASKS_INDEX_NAME):
+            # The triggers were dropped with the old table
+            cursor.execute('insert into ' + self.TASKS_INDEX_NAME + '(' +
+                           self.TASKS_INDEX_NAME + ') values (\'rebuild\')')
+            self._createTasksIndexTriggers()
+
+    def _migrateFrom5(self):
+        '''
+        Version 6 adds the trigram index
+        '''
+        self._createTrigramIndex()
+        if self._tableExists(self.TRIGRAM_INDEX_NAME):
+            self._rebuildTrigramIndex(self._dbconn.cursor())
+
+    def _migrateFrom6(self):
+        '''
+        Version 7 indexes the trigrams of the words of the names, padded and
+        without diacritics, instead of those of the names
+        '''
+        cursor = self._dbconn.cursor()
+        for trigger in ('tasks_trigram_ai', 'tasks_trigram_ad', 'tasks_trigram_au'):
+            cursor.execute('drop trigger if exists ' + trigger)
+        cursor.execute('drop table if exists ' + self.TRIGRAM_INDEX_NAME)
+        self._migrateFrom5()
+
+    def _tableExists(self, tableName):
+        cursor = self._dbconn.cursor()
+        cursor.execute("select name from sqlite_master where type='table' and name=(?)", (tableName,))
+        return cursor.fetchone() is not None
+
+    def _dropTables(self):
+        '''
+        Drops every table of the database
+        '''
+        cursor = self._dbconn.cursor()
+        for tableName in (self.TASKS_INDEX_NAME, self.TRIGRAM_INDEX_NAME, self.TASKS_TABLE_NAME,
+                          self.LISTS_TABLE_NAME, self.SYNC_TABLE_NAME):
+            cursor.execute('drop table if exists ' + tableName)
+
     def _createTasksTable(self):
         '''
         Creates the table to store the tasks
         '''
         cursor = self._dbconn.cursor()
-        # list-id, task-series-id and task-id are a primary key
+        # list-id, task-series-id and task-id are a primary key (the table
+        # keeps its rowid, used by the full text index)
         cursor.execute('''create table ''' + self.TASKS_TABLE_NAME +
         ''' (listid    text,
         taskseriesid   text,
@@ -84,8 +314,31 @@ class TasksDB(object):
         completed      text,
         name           text,
         due            text,
-        priority       text)
+        priority       text,
+        primary key (listid, taskseriesid, taskid))
         ''')
+        # Merging a tasks delta looks tasks up by task series
+        cursor.execute('create index tasks_taskseriesid on ' + self.TASKS_TABLE_NAME +
+                       ' (taskseriesid)')
+        self._createOrderingIndexes()
+
+    def _createOrderingIndexes(self):
+        '''
+        Each ordering of getTasks is read from an index, both for all the
+        tasks and for the uncompleted ones only
+        '''
+        cursor = self._dbconn.cursor()
+        for column in self._orderings:
+            cursor.execute('create index tasks_' + column + ' on ' + self.TASKS_TABLE_NAME +
+                           ' (' + column + ')')
+            cursor.execute('create index tasks_completed_' + column + ' on ' +
+                           self.TASKS_TABLE_NAME + ' (completed, ' + column + ')')
+
+    def _dropOrderingIndexes(self):
+        cursor = self._dbconn.cursor()
+        for column in self._orderings:
+            cursor.execute('drop index if exists tasks_' + column)
+            cursor.execute('drop index if exists tasks_completed_' + column)
 
     def _createListsTable(self):
         '''
@@ -94,9 +347,99 @@ class TasksDB(object):
         '''
         cursor = self._dbconn.cursor()
         cursor.execute('''CREATE TABLE ''' + self.LISTS_TABLE_NAME +
-        '''(listid text,
+        '''(listid text primary key,
         listname   text)
         ''')
+        # Categories are selected by name
+        cursor.execute('create index lists_listname on ' + self.LISTS_TABLE_NAME +
+                       ' (listname)')
+
+    def _createTasksIndex(self):
+        '''
+        Creates the full text index on the names of the tasks, kept up to
+        date by triggers on the tasks table
+        '''
+        cursor = self._dbconn.cursor()
+        try:
+            cursor.execute('create virtual table ' + self.TASKS_INDEX_NAME +
+                           ' using fts5(name, content=' + self.TASKS_TABLE_NAME +
+                           ', content_rowid=rowid)')
+        except sqlite3.OperationalError:
+            # FTS5 not available
+            return
+        self._createTasksIndexTriggers()
+
+    def _createTasksIndexTriggers(self):
+        cursor = self._dbconn.cursor()
+        cursor.execute('create trigger tasks_ai after insert on ' + self.TASKS_TABLE_NAME +
+                       ' begin insert into ' + self.TASKS_INDEX_NAME + '(rowid, name)' +
+                       ' values (new.rowid, new.name); end')
+        cursor.execute('create trigger tasks_ad after delete on ' + self.TASKS_TABLE_NAME +
+                       ' begin insert into ' + self.TASKS_INDEX_NAME + '(' + self.TASKS_INDEX_NAME +
+                       ', rowid, name) values (\'delete\', old.rowid, old.name); end')
+        cursor.execute('create trigger tasks_au after update of name on ' + self.TASKS_TABLE_NAME +
+                       ' begin insert into ' + self.TASKS_INDEX_NAME + '(' + self.TASKS_INDEX_NAME +
+                       ', rowid, name) values (\'delete\', old.rowid, old.name);' +
+                       ' insert into ' + self.TASKS_INDEX_NAME + '(rowid, name)' +
+                       ' values (new.rowid, new.name); end')
+
+    def _createTrigramIndex(self):
+        '''
+        Creates the index of the trigrams of the names of the tasks, kept
+        up to date by triggers on the tasks table. The index has no content:
+        it stores the trigrams of the search text of the names (see
+        _searchText), so that the trigrams of the search phrase are
+        computed the same way as those of the SearchRanker.
+        '''
+        cursor = self._dbconn.cursor()
+        try:
+            cursor.execute('create virtual table ' + self.TRIGRAM_INDEX_NAME +
+                           ' using fts5(name, content=\'\', tokenize=\'trigram\')')
+        except sqlite3.OperationalError:
+            # FTS5 or the trigram tokenizer not available
+            return
+        self._createTrigramIndexTriggers()
+
+    def _createTrigramIndexTriggers(self):
+        cursor = self._dbconn.cursor()
+        cursor.execute('create trigger tasks_trigram_ai after insert on ' + self.TASKS_TABLE_NAME +
+                       ' begin insert into ' + self.TRIGRAM_INDEX_NAME + '(rowid, name)' +
+                       ' values (new.rowid, searchtext(new.name)); end')
+        cursor.execute('create trigger tasks_trigram_ad after delete on ' + self.TASKS_TABLE_NAME +
+                       ' begin insert into ' + self.TRIGRAM_INDEX_NAME + '(' + self.TRIGRAM_INDEX_NAME +
+                       ', rowid, name) values (\'delete\', old.rowid, searchtext(old.name)); end')
+        cursor.execute('create trigger tasks_trigram_au after update of name on ' + self.TASKS_TABLE_NAME +
+                       ' begin insert into ' + self.TRIGRAM_INDEX_NAME + '(' + self.TRIGRAM_INDEX_NAME +
+                       ', rowid, name) values (\'delete\', old.rowid, searchtext(old.name));' +
+                       ' insert into ' + self.TRIGRAM_INDEX_NAME + '(rowid, name)' +
+                       ' values (new.rowid, searchtext(new.name)); end')
+
+    def _dropTasksIndexTriggers(self):
+        cursor = self._dbconn.cursor()
+        for trigger in ('tasks_ai', 'tasks_ad', 'tasks_au',
+                        'tasks_trigram_ai', 'tasks_trigram_ad', 'tasks_trigram_au'):
+            cursor.execute('drop trigger if exists ' + trigger)
+
+    def _rebuildIndex(self, cursor, indexName):
+        cursor.execute('insert into ' + indexName + '(' + indexName + ') values (\'rebuild\')')
+
+    def _rebuildTrigramIndex(self, cursor):
+        # The index has no content to be rebuilt from
+        cursor.execute('insert into ' + self.TRIGRAM_INDEX_NAME + '(' + self.TRIGRAM_INDEX_NAME +
+                       ') values (\'delete-all\')')
+        cursor.execute('insert into ' + self.TRIGRAM_INDEX_NAME + '(rowid, name)' +
+                       ' select rowid, searchtext(name) from ' + self.TASKS_TABLE_NAME)
+
+    def _createSyncTable(self):
+        '''
+        Creates the table to store the synchronization state (e.g., the time
+        of the last sync with the RTM service), as key/value pairs
+        '''
+        cursor = self._dbconn.cursor()
+        cursor.execute('''CREATE TABLE ''' + self.SYNC_TABLE_NAME +
+        '''(key    text primary key,
+        value      text)
+        ''')
 
     def _cleanDatabaseEntries(self, tableName):
         '''
@@ -112,69 +455,334 @@ class TasksDB(object):
         http://www.rememberthemilk.com/services/api/methods/rtm.tasks.getList.rtm)
         and store data in SqLite.
         '''
-        # delete the whole database as we received fresh information
-        self._cleanDatabaseEntries(self.TASKS_TABLE_NAME)
-        cursor = self._dbconn.cursor()
-        # iterate over the elements and populate database
+        self.storeTaskRecords(self._taskRecords(taskLists))
+
+    def mergeTasks(self, taskLists):
+        '''
+        Merges the xml based representation of a tasks delta, as returned by
+        rtm.tasks.getList when called with the last_sync argument, into the
+        database (see mergeTaskRecords).
+        '''
+        return self.mergeTaskRecords(self._taskRecords(taskLists))
+
+    @_synchronized
+    def storeTaskRecords(self, records):
+        '''
+        Replaces the stored tasks with the given TaskRecord objects (see
+        rtmapi.iter_task_records), which are inserted while they are decoded.
+        The database is locked meanwhile: to keep other threads waiting only
+        for the insert, pass the decoded records.
+        '''
+        with self._transaction() as cursor:
+            # Updating the full text index row by row is much slower than
+            # rebuilding it at the end
+            self._dropTasksIndexTriggers()
+            # The same goes for the indexes of the orderings
+            self._dropOrderingIndexes()
+            # delete the whole database as we received fresh information
+            self._cleanDatabaseEntries(self.TASKS_TABLE_NAME)
+            self._bulkInsert(cursor, self.TASKS_TABLE_NAME,
+                             (record[:7] for record in records if record.deleted is None))
+            self._createOrderingIndexes()
+            if self._indexEnabled:
+                self._rebuildIndex(cursor, self.TASKS_INDEX_NAME)
+                self._createTasksIndexTriggers()
+            if self._trigramEnabled:
+                self._rebuildTrigramIndex(cursor)
+                self._createTrigramIndexTriggers()
+        self._notifyChanges(None)
+
+    @_synchronized
+    def mergeTaskRecords(self, records):
+        '''
+        Merges the TaskRecord objects of a tasks delta into the database.
+        Added and changed task series replace the stored ones, deleted tasks
+        are removed.
+
+        Returns the number of task series and deleted tasks merged.
+        '''
+        changes = 0
+        taskSeriesIds = set()
+        with self._transaction() as cursor:
+            for batch in self._batches(records):
+                changed = [record for record in batch if record.deleted is None]
+                deleted = [record for record in batch if record.deleted is not None]
+                # Task series ids are unique across lists, this also handles
+                # task series moved to a different list
+                cursor.executemany('delete from ' + self.TASKS_TABLE_NAME +
+                                   ' where taskseriesid=(?)',
+                                   [(record.taskseries_id,) for record in changed])
+                self._bulkInsert(cursor, self.TASKS_TABLE_NAME,
+                                 [record[:7] for record in changed])
+                cursor.executemany('delete from ' + self.TASKS_TABLE_NAME +
+                                   ' where listid=(?) and taskseriesid=(?) and taskid=(?)',
+                                   [record[:3] for record in deleted])
+                changes += len(batch)
+                taskSeriesIds.update(record.taskseries_id for record in batch)
+        if changes > 0:
+            self._notifyChanges(taskSeriesIds)
+        return changes
+
+    def addChangeListener(self, listener):
+        '''
+        Registers a function to be called when the stored tasks change. The
+        function receives the set of the ids of the changed task series, or
+        None if all the tasks were replaced. It is called in the thread
+        changing the database.
+        '''
+        self._changeListeners.append(listener)
+
+    def _notifyChanges(self, taskSeriesIds):
+        self.generation += 1
+        for listener in self._changeListeners:
+            listener(taskSeriesIds)
+
+    def _batches(self, records):
+        '''
+        Groups the records in lists of at most MERGE_BATCH_SIZE elements
+        '''
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) == self.MERGE_BATCH_SIZE:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+
+    def _bulkInsert(self, cursor, tableName, rows):
+        '''
+        Inserts the rows (tuples with a value for each column of tableName)
+        with a single statement, records the ingest rate in lastIngestStats
+        and passes it to ingestObserver
+        '''
+        counter = [0]
+        def counted(rows):
+            for row in rows:
+                counter[0] += 1
+                yield row
+        start = time()
+        # A row received twice replaces the previous one
+        cursor.executemany('insert or replace into ' + tableName + ' values (' +
+                           ','.join(['?'] * self._columnsCount[tableName]) + ')',
+                           counted(rows))
+        elapsed = time() - start
+        self.lastIngestStats = {'table': tableName,
+                                'rows': counter[0],
+                                'seconds': elapsed,
+                                'rowsPerSecond': counter[0] / elapsed if elapsed > 0 else 0}
+        if self.ingestObserver is not None:
+            self.ingestObserver(self.lastIngestStats)
+
+    def _taskRecords(self, taskLists):
+        '''
+        Generates the TaskRecord objects for the xml based representation of
+        tasks (only the first task of each task series is considered)
+        '''
         for taskList in taskLists.tasks:
             for taskseries in taskList:
-                row = [taskList.id,
-                       taskseries.id,
-                       taskseries.task.id,
-                       taskseries.task.completed,
-                       taskseries.name,
-                       taskseries.task.due,
-                       taskseries.task.priority]
-                cursor.execute('insert into ' + self.TASKS_TABLE_NAME + ' values (?,?,?,?,?,?,?)', row)
+                yield TaskRecord(taskList.id,
+                                 taskseries.id,
+                                 taskseries.task.id,
+                                 taskseries.task.completed,
+                                 taskseries.name,
+                                 taskseries.task.due,
+                                 taskseries.task.priority,
+                                 None)
+            for taskseries in taskList.deleted_taskseries:
+                for task in taskseries:
+                    yield TaskRecord(taskList.id, taskseries.id, task.id,
+                                     None, None, None, None, task.deleted)
 
     def storeLists(self, lists):
         '''
         Parses the XML representation of lists and populates the LISTS database
         '''
-        # delete the whole database as we received fresh information
-        self._cleanDatabaseEntries(self.LISTS_TABLE_NAME)
+        self.storeListRecords(ListRecord(entry.id, entry.name) for entry in lists.lists)
+
+    @_synchronized
+    def setTaskCompleted(self, listId, taskSeriesId, taskId, completed):
+        '''
+        Sets the completed field of a task (u'' for uncompleted tasks).
+        Returns the previous value, None if the task is not stored.
+        '''
+        with self._transaction() as cursor:
+            cursor.execute('select completed from ' + self.TASKS_TABLE_NAME +
+                           ' where listid=(?) and taskseriesid=(?) and taskid=(?)',
+                           (listId, taskSeriesId, taskId))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            cursor.execute('update ' + self.TASKS_TABLE_NAME + ' set completed=(?)' +
+                           ' where listid=(?) and taskseriesid=(?) and taskid=(?)',
+                           (completed, listId, taskSeriesId, taskId))
+        self._notifyChanges(set([taskSeriesId]))
+        return row[0]
+
+    @_synchronized
+    def storeListRecords(self, records):
+        '''
+        Replaces the stored lists with the given ListRecord objects (see
+        rtmapi.iter_list_records)
+        '''
+        with self._transaction() as cursor:
+            # delete the whole database as we received fresh information
+            self._cleanDatabaseEntries(self.LISTS_TABLE_NAME)
+            self._bulkInsert(cursor, self.LISTS_TABLE_NAME, records)
+        self.generation += 1
+
+    @_synchronized
+    def getLists(self):
+        '''
+        Returns the stored lists (ListRecord objects), in the order provided
+        by RTM
+        '''
         cursor = self._dbconn.cursor()
-        # iterate over the elements and populate database
-        for entry in lists.lists:
-            row = [entry.id, entry.name]
-            cursor.execute('insert into ' + self.LISTS_TABLE_NAME + ' values (?,?)', row)
+        cursor.execute('select listid, listname from ' + self.LISTS_TABLE_NAME + ' order by rowid')
+        return [ListRecord(*row) for row in cursor]
 
+    @_synchronized
+    def getListNames(self):
+        '''
+        Returns the names of the stored lists, in the order provided by RTM
+        '''
+        cursor = self._dbconn.cursor()
+        cursor.execute('select listname from ' + self.LISTS_TABLE_NAME + ' order by rowid')
+        return [row[0] for row in cursor]
+
+    @_synchronized
+    def getSyncValue(self, key, default = None):
+        '''
+        Returns the synchronization value stored for key, or default
+        '''
+        cursor = self._dbconn.cursor()
+        cursor.execute('select value from ' + self.SYNC_TABLE_NAME + ' where key=(?)', (key,))
+        row = cursor.fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    @_synchronized
+    def setSyncValue(self, key, value):
+        '''
+        Stores the synchronization value for key (None deletes it)
+        '''
+        cursor = self._dbconn.cursor()
+        if value is None:
+            cursor.execute('delete from ' + self.SYNC_TABLE_NAME + ' where key=(?)', (key,))
+        else:
+            cursor.execute('insert or replace into ' + self.SYNC_TABLE_NAME + ' values (?,?)', (key, value))
+
+    @_synchronized
     def dumpTasks(self):
         cursor = self._dbconn.cursor()
         output = cursor.execute('select * from ' + self.TASKS_TABLE_NAME)
         return output
     
-    def getTasks(self, categoryName, orderBy, showCompleted):
+    @_synchronized
+    def getTasks(self, categoryName, orderBy, showCompleted, search = None, limit = None):
         '''
         Given the string name of a category, returns all the tasks
         belonging to that category, ordered on the specified column (if not
         None) and also providing uncompleted tasks if showCompleted is True.
+
+        If search is not None, only the tasks with a name containing words
+        starting with each of the words of search are returned. If limit
+        is not None, only the first limit tasks are returned.
         
         Return type is a list of dictionaries, one for each task.
         E.g.: [{'taskseriesid': u'xxx', 'name': u'xxx', 'due': u'', 
                 'priority': u'N', 'listid': u'xxx', 'taskid': u'xxx'},
                {'taskseriesid': u'xxx', 'name': u'xxx', 'due': u'',
                 'priority': u'N', 'listid': u'xxx', 'taskid': u'xxx'}]
+
+        The results of the last calls are kept until the stored tasks or
+        lists change (see queryCacheStats): the dictionaries are shared
+        between calls with the same arguments and must not be modified.
         '''
-        
-        cursor = self._dbconn.cursor()
-        
-        category_where = ''
-        if categoryName is not None:
-            category_where = " and listname=\'" + categoryName + "\'"
+        return self._cachedQuery((categoryName, orderBy, showCompleted, search, limit),
+                                 self._queryTasks, categoryName, orderBy, showCompleted, search, limit)
 
-        # Order by statement
-        if orderBy is not None:
-            orderByStm = ' ORDER BY ' + orderBy
+    @_synchronized
+    def getFuzzyTasks(self, categoryName, showCompleted, search, limit):
+        '''
+        Returns, like getTasks, at most limit tasks with names sharing
+        trigrams with the words of search (or with their variants with two
+        adjacent letters swapped), those sharing the most first.
+        They are the candidates of a search tolerating typos: they don't
+        necessarily match search.
+
+        Returns an empty list if the trigram index is not available or
+        search has no words of at least three characters.
+        '''
+        return self._cachedQuery(('fuzzy', categoryName, showCompleted, search, limit),
+                                 self._queryFuzzyTasks, categoryName, showCompleted, search, limit)
+
+    def _cachedQuery(self, key, query, *args):
+        '''
+        Returns the result of query(*args) kept in the query cache with the
+        given key, calling query first if it's not there
+        '''
+        if self._queryCacheGeneration != self.generation:
+            self._queryCache.clear()
+            self._queryCacheGeneration = self.generation
+        tasks = self._queryCache.pop(key, None)
+        if tasks is not None:
+            self._queryCacheHits += 1
         else:
-            orderByStm = ""
+            self._queryCacheMisses += 1
+            tasks = query(*args)
+        # Most recently used last
+        self._queryCache[key] = tasks
+        if len(self._queryCache) > self.QUERY_CACHE_SIZE:
+            self._queryCache.popitem(last = False)
+        return list(tasks)
+
+    @_synchronized
+    def queryCacheStats(self):
+        '''
+        Returns a dictionary with the number of getTasks (and
+        getFuzzyTasks) calls answered
+        from the cache ("hits") and from the database ("misses"), and the
+        number of results in the cache ("size")
+        '''
+        return {"hits": self._queryCacheHits,
+                "misses": self._queryCacheMisses,
+                "size": len(self._queryCache)}
+
+    def _queryTasks(self, categoryName, orderBy, showCompleted, search, limit):
+        '''
+        Reads from the database the tasks returned by getTasks
+        '''
+        if orderBy is not None and orderBy not in self._orderings:
+            raise ValueError('Cannot order the tasks by {}'.format(orderBy))
+
+        cursor = self._dbconn.cursor()
+        params = []
 
         if showCompleted is True:
             # will show completed and uncompleted tasks
             completedStm = ""
         else:
             # only uncompleted tasks
-            completedStm = " and completed=\'\' "
+            completedStm = " and completed=''"
+
+        category_where = ''
+        if categoryName is not None:
+            category_where = " and listname=(?)"
+            params.append(categoryName)
+
+        search_where, searchParams = self._searchStatement(search)
+        params.extend(searchParams)
+
+        # Order by statement (ties in the order of insertion)
+        if orderBy is not None:
+            orderByStm = ' order by ' + orderBy + ', tasks.rowid'
+        else:
+            orderByStm = ""
+        if limit is not None:
+            orderByStm += ' limit (?)'
+            params.append(limit)
 
         # Get all the specified columns from DB
         select = 'select ' + (', ').join(self.columns)
@@ -182,19 +790,132 @@ class TasksDB(object):
                     ' from ' + self.TASKS_TABLE_NAME + ' as tasks, ' + 
                     self.LISTS_TABLE_NAME + ' as lists ' +
                     ' where tasks.listid = lists.listid' + completedStm +
-                    category_where + 
-                    orderByStm)
+                    category_where + search_where +
+                    orderByStm, params)
         
-        # prepare a dictionary to return the tasks
+        return self._taskDictionaries(tasks)
+
+    def _queryFuzzyTasks(self, categoryName, showCompleted, search, limit):
+        '''
+        Reads from the database the tasks returned by getFuzzyTasks
+        '''
+        if not self._trigramEnabled:
+            return []
+        # The trigrams of the words and of their variants with two adjacent
+        # letters swapped (the most common typo, sharing few trigrams with
+        # the right word), padded as in the index
+        trigrams = set()
+        for word in self.searchTokens(search):
+            if len(word) < 3:
+                continue
+            for variant in self._transpositions(word):
+                padded = u' ' + variant + u' '
+                trigrams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+        if len(trigrams) == 0:
+            return []
+
+        # Any trigram matches, the rank (bm25) is better for the names
+        # with more of them
+        params = [' OR '.join('"' + trigram + '"' for trigram in sorted(trigrams))]
+        completedStm = "" if showCompleted is True else " and completed=''"
+        category_where = ''
+        if categoryName is not None:
+            category_where = " and listname=(?)"
+            params.append(categoryName)
+        params.append(limit)
+
+        cursor = self._dbconn.cursor()
+        tasks = cursor.execute('select ' + (', ').join(self.columns) +
+                    ' from (select rowid as matchid, rank as matchrank from ' + self.TRIGRAM_INDEX_NAME +
+                    ' where ' + self.TRIGRAM_INDEX_NAME + ' match (?)) as matches, ' +
+                    self.TASKS_TABLE_NAME + ' as tasks, ' + self.LISTS_TABLE_NAME + ' as lists ' +
+                    ' where tasks.rowid = matches.matchid' +
+                    ' and tasks.listid = lists.listid' + completedStm + category_where +
+                    ' order by matches.matchrank limit (?)', params)
+        return self._taskDictionaries(tasks)
+
+    @staticmethod
+    def _transpositions(word):
+        '''
+        Returns the word and its variants with two adjacent letters swapped
+        '''
+        variants = set([word])
+        for i in range(len(word) - 1):
+            variants.add(word[:i] + word[i + 1] + word[i] + word[i + 2:])
+        return variants
+
+    @classmethod
+    def _searchText(cls, name):
+        '''
+        Returns the text of a task name indexed by the trigram index: its
+        search tokens (see searchTokens) separated and surrounded by spaces,
+        so that the short words have trigrams too
+        '''
+        if name is None:
+            return None
+        return u' ' + u' '.join(cls.searchTokens(name)) + u' '
+
+    def _taskDictionaries(self, rows):
+        '''
+        Returns a dictionary for each row with the columns of self.columns
+        '''
         ldic = []
-        for row in tasks:
+        for row in rows:
             d = {}
             for index, column in enumerate(self.columns):
                 d[column] = row[index]
             ldic.append(d)
-        
         return ldic
     
+    def _searchStatement(self, search):
+        '''
+        Returns the where statement (and its parameters) selecting the tasks
+        matching the search phrase
+        '''
+        if search is None:
+            return '', ()
+        words = self.WORDS_RE.findall(search)
+        if self._indexEnabled and len(words) > 0:
+            # Every word must be the prefix of a word in the name
+            query = ' '.join('"' + word + '"*' for word in words)
+            return (' and tasks.rowid in (select rowid from ' + self.TASKS_INDEX_NAME +
+                    ' where ' + self.TASKS_INDEX_NAME + ' match (?))', (query,))
+        # Substring search (case insensitive for ASCII characters)
+        pattern = '%' + search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        return " and name like (?) escape '\\'", (pattern,)
+
+    def searchWords(self, search):
+        '''
+        Returns the words that getTasks looks for at the beginning of the
+        words of the task names (lowercase, without diacritics, see
+        searchTokens), or None if search is not done word by word (e.g. the
+        full text index is not available)
+        '''
+        if search is None or not self._indexEnabled:
+            return None
+        words = self.WORDS_RE.findall(search)
+        if len(words) == 0 or any('_' in word for word in words):
+            return None
+        return list(self.searchTokens(' '.join(words)))
+
+    @classmethod
+    def searchTokens(cls, text):
+        '''
+        Splits text in words like the full text index does, returns them
+        lowercase and without diacritics
+        '''
+        if isinstance(text, str):
+            text = text.decode('utf-8', 'replace')
+        text = text.lower()
+        try:
+            text.encode('ascii')
+        except UnicodeEncodeError:
+            # ASCII text has no diacritics to remove
+            text = unicodedata.normalize('NFKD', text)
+            text = u''.join(c for c in text if not unicodedata.combining(c))
+        return tuple(cls.TOKENS_RE.findall(text))
+
+    @_synchronized
     def getTaskById(self, taskId, listId, taskSeriesId):
         '''
         Given a list id, task id and task series id, returns a dictionary
@@ -202,11 +923,12 @@ class TasksDB(object):
         '''
         cursor = self._dbconn.cursor()
         select = "select " + (", ").join(self.columns)
+        # The ids are looked up with the index of the primary key
         task = cursor.execute(select + " from " + self.TASKS_TABLE_NAME + " as tasks, " +
                self.LISTS_TABLE_NAME + " as lists "
-               " where tasks.listid = lists.listid and "
-               " tasks.listid=(?) and tasks.taskseriesid=(?) and "
-               " tasks.taskid=(?)", (listId, taskSeriesId, taskId))
+               " where tasks.listid=(?) and tasks.taskseriesid=(?) and "
+               " tasks.taskid=(?) and tasks.listid = lists.listid",
+               (listId, taskSeriesId, taskId))
         
         row = cursor.fetchone()
         if row is None:
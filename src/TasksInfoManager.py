@@ -24,9 +24,14 @@
 #    certified by Remember The Milk.
 
 
-from time import time, timezone, altzone, localtime
+from math import ceil
+from time import time, timezone, altzone, localtime, gmtime, strftime
 from datetime import datetime, timedelta
+from email.utils import parsedate_tz, mktime_tz
 from TasksDB import TasksDB
+from WriteQueue import WriteQueue
+from rtmapi import RtmException, RequestScheduler
+import threading
 
 class TasksInfoManager(object):
     '''
@@ -36,6 +41,18 @@ class TasksInfoManager(object):
     # Time interval to consider the tasksList cache old (in seconds)
     TASKS_LIST_UPDATE_INTERVAL = 20
 
+    # Time interval after which a full download of the tasks is performed
+    # instead of an incremental one (in seconds)
+    TASKS_LIST_FULL_SYNC_INTERVAL = 3600
+
+    # Format of the last_sync argument of rtm.tasks.getList
+    LAST_SYNC_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+    # Keys of the synchronization state persisted in the database
+    SYNC_LAST_SYNC_KEY = "last_sync"
+    SYNC_FULL_SYNC_KEY = "full_sync_timestamp"
+    SYNC_UPDATE_KEY = "update_timestamp"
+
     # String representing the ID for the priority ordering filter
     ORDERING_PRIORITY_ID = TasksDB.TPRIORITY
     # String representing the ID for the due date ordering filter
@@ -43,15 +60,36 @@ class TasksInfoManager(object):
     # String representing the ID for the due date ordering filter
     ORDERING_NAMES_ID = TasksDB.TNAME
 
-    def __init__(self, listsManager):
+    # RTM error codes meaning that a write can be sent again later (the
+    # token is not valid, but the user can authorize the lens again)
+    # See http://www.rememberthemilk.com/services/api/response.rtm
+    RETRY_ERROR_CODES = ('98',)
+
+    def __init__(self, listsManager, writeQueue = None):
         super(TasksInfoManager, self).__init__()
         
-        # RTM Tasks XML representation
-        # See http://www.rememberthemilk.com/services/api/methods/rtm.tasks.getList.rtm
-        self._tasksList = None
-
         # The timestamp associated with the tasks list
         self._tasksListTimestamp = 0
+
+        # Server time (in the last_sync format) of the last successful
+        # download of the tasks, None if a full download is needed
+        self._lastSync = None
+
+        # The timestamp of the last full download of the tasks
+        self._fullSyncTimestamp = 0
+
+        # True when the synchronization state has been read from the database
+        self._syncStateLoaded = False
+
+        # Downloads can be requested by different threads at the same time
+        self._downloadLock = threading.Lock()
+
+        # Timeline for the write operations, reused for the whole session
+        self._timeline = None
+        self._timelineLock = threading.Lock()
+
+        # Changes made locally, still to be sent to RTM
+        self._writeQueue = writeQueue if writeQueue is not None else WriteQueue()
         
         # Reference to the lists manager object
         self._listsManager = listsManager
@@ -62,23 +100,133 @@ class TasksInfoManager(object):
 
     def downloadTasksList(self, rtmApi, db):
         '''
-        Downloads the tasks from RTM if the cached list is empty or too old
+        Downloads the tasks from RTM if the cached list is empty or too old.
+
+        After the first full download, only the tasks changed since the last
+        sync are requested (see the last_sync argument of rtm.tasks.getList)
+        and merged into the database.
+
+        Returns True if the tasks stored in the database may have changed.
         '''
-        if self._tasksList == None or self._tasksListExpired() == True:
-            # get all open tasks, see http://www.rememberthemilk.com/services/api/methods/rtm.tasks.getList.rtm
-            #self._tasksList = rtmApi.rtm.tasks.getList(filter="status:incomplete")
-            self._tasksList = rtmApi.rtm.tasks.getList()
-            
-            # Store tasks in database
-            db.storeTasks(self._tasksList)
-            
-            # Get the lists, see http://www.rememberthemilk.com/services/api/methods/rtm.lists.getList.rtm
-            lists = rtmApi.rtm.lists.getList()
+        with self._downloadLock:
+            self._loadSyncState(db)
+            if self._tasksListExpired() == False:
+                return False
+
+            # Local time, used when the server doesn't provide its own
+            requestTime = datetime.utcnow().strftime(self.LAST_SYNC_FORMAT)
+            requestStart = time()
+
+            # get the tasks (see http://www.rememberthemilk.com/services/api/methods/rtm.tasks.getList.rtm)
+            # and the lists (see http://www.rememberthemilk.com/services/api/methods/rtm.lists.getList.rtm)
+            # at the same time
+            fullSync = self._fullSyncNeeded()
+            if fullSync:
+                # all the tasks
+                #getTasks = lambda: rtmApi.rtm.tasks.getList.stream(filter="status:incomplete")
+                getTasks = lambda: rtmApi.rtm.tasks.getList.stream()
+            else:
+                # only the tasks changed since the last sync
+                lastSync = self._lastSync
+                getTasks = lambda: rtmApi.rtm.tasks.getList.stream(last_sync = lastSync)
+            tasks, lists = rtmApi.parallel(getTasks, lambda: rtmApi.rtm.lists.getList.stream())
+            # The next delta starts when this request was sent: the tasks
+            # changed while RTM was building the response are downloaded
+            # again, instead of being missed (merging them is harmless)
+            serverTime = self._serverTime(tasks, requestTime, time() - requestStart)
+
+            # Decoded while the responses are read (their bodies are never
+            # in memory as a whole, see rtmapi.RtmStream), but before taking
+            # the database lock, which searches, previews and task changes
+            # made in the main loop wait for: only the compact records are
+            # kept until they are stored
+            records = list(tasks)
+            lists = list(lists)
+
+            if fullSync:
+                db.storeTaskRecords(records)
+                self._fullSyncTimestamp = self._now()
+                changed = True
+            else:
+                try:
+                    changed = db.mergeTaskRecords(records) > 0
+                except Exception:
+                    # The local copy can't be trusted anymore
+                    self._lastSync = None
+                    db.setSyncValue(self.SYNC_LAST_SYNC_KEY, None)
+                    raise
+
+            # The downloaded tasks don't include the writes not sent yet
+            self._reapplyPendingWrites(db)
+            self._writeQueue.kick()
+
+            self._lastSync = serverTime
             
-            db.storeLists(lists)
+            db.storeListRecords(lists)
             
             # update the local cache timestamp
             self._tasksListTimestamp = self._now()
+            self._saveSyncState(db)
+            return changed
+
+    def hasLocalTasks(self, db):
+        '''
+        Returns True if the database contains a (possibly old) copy of the
+        tasks, which can be displayed while a new one is downloaded
+        '''
+        self._loadSyncState(db)
+        return self._lastSync is not None
+
+    def isDownloadNeeded(self, db):
+        '''
+        Returns True if downloadTasksList would contact the RTM service
+        '''
+        self._loadSyncState(db)
+        return self._tasksListExpired()
+
+    def _loadSyncState(self, db):
+        """
+        Reads the synchronization state stored in the database, so that a
+        persistent database is not downloaded again after a restart
+        """
+        if self._syncStateLoaded:
+            return
+        self._lastSync = db.getSyncValue(self.SYNC_LAST_SYNC_KEY)
+        self._fullSyncTimestamp = int(db.getSyncValue(self.SYNC_FULL_SYNC_KEY, 0))
+        self._tasksListTimestamp = int(db.getSyncValue(self.SYNC_UPDATE_KEY, 0))
+        self._syncStateLoaded = True
+
+    def _saveSyncState(self, db):
+        """
+        Stores the synchronization state in the database
+        """
+        db.setSyncValue(self.SYNC_LAST_SYNC_KEY, self._lastSync)
+        db.setSyncValue(self.SYNC_FULL_SYNC_KEY, str(self._fullSyncTimestamp))
+        db.setSyncValue(self.SYNC_UPDATE_KEY, str(self._tasksListTimestamp))
+
+    def _fullSyncNeeded(self):
+        """
+        Returns True if the whole tasks list must be downloaded
+        """
+        if self._lastSync is None:
+            return True
+        return self._now() - self._fullSyncTimestamp > self.TASKS_LIST_FULL_SYNC_INTERVAL
+
+    def _serverTime(self, response, default, elapsed = 0):
+        """
+        Returns the server time at which the request of the response was
+        sent, in the last_sync format: the time at which the server produced
+        the response, minus the elapsed seconds since the request was sent
+        (measured locally, so that the clocks don't need to agree).
+        Returns default if the server didn't provide its time.
+        """
+        serverTime = getattr(response, 'server_time', None)
+        if serverTime is None:
+            return default
+        parsed = parsedate_tz(serverTime)
+        if parsed is None:
+            return default
+        return strftime(self.LAST_SYNC_FORMAT, gmtime(mktime_tz(parsed) - int(ceil(elapsed))))
 
     def _tasksListExpired(self):
         """
@@ -95,31 +243,101 @@ class TasksInfoManager(object):
         """
         return int(time())
 
-    def markCompleted(self, rtmApi, listId, taskSeriesId, taskId):
+    def startWriteQueue(self, rtmApi, db, listener = None, authManager = None):
+        '''
+        Starts sending the task changes made locally (including the ones left
+        by the last session) to RTM. listener, if not None, is called (in
+        another thread) when some changes have been sent. authManager, if
+        not None, is told about the writes rejected because of the token
+        (see AuthManager.invalidateOnAuthError).
+        '''
+        self._reapplyPendingWrites(db)
+        self._writeQueue.start(lambda write: self._sendTaskWrite(rtmApi, db, write, authManager),
+                               listener)
+
+    def markCompleted(self, db, listId, taskSeriesId, taskId):
         '''
         Mark the task identified by the given IDs as completed.
+        See _writeTask for the details.
         '''
-        # The operation requires a timeline
-        result = rtmApi.rtm.timelines.create()
-        timeline = result.timeline.value
-        # Complete task
-        rtmApi.rtm.tasks.complete(timeline = timeline,
-                                  list_id = listId,
-                                  taskseries_id = taskSeriesId,
-                                  task_id = taskId)
+        completed = datetime.utcnow().strftime(self.LAST_SYNC_FORMAT)
+        # see http://www.rememberthemilk.com/services/api/methods/rtm.tasks.complete.rtm
+        self._writeTask(db, 'complete', completed, listId, taskSeriesId, taskId)
 
-    def markUncompleted(self, rtmApi, listId, taskSeriesId, taskId):
+    def markUncompleted(self, db, listId, taskSeriesId, taskId):
         '''
         Mark the task identified by the given IDs as not completed.
+        See _writeTask for the details.
+        '''
+        # see http://www.rememberthemilk.com/services/api/methods/rtm.tasks.uncomplete.rtm
+        self._writeTask(db, 'uncomplete', u'', listId, taskSeriesId, taskId)
+
+    def _writeTask(self, db, method, completed, listId, taskSeriesId, taskId):
+        '''
+        Changes the completed status of a task in the database immediately,
+        then queues the change to be sent to RTM (see startWriteQueue).
+        The database is updated again with the status returned by RTM, or
+        restored if RTM rejects the change.
+        '''
+        previous = db.setTaskCompleted(listId, taskSeriesId, taskId, completed)
+        self._writeQueue.add({'method': method,
+                              'args': {'list_id': listId,
+                                       'taskseries_id': taskSeriesId,
+                                       'task_id': taskId},
+                              'key': [listId, taskSeriesId, taskId],
+                              'completed': completed,
+                              'previous': previous})
+
+    def _reapplyPendingWrites(self, db):
+        '''
+        Applies the writes not sent yet to the tasks stored in the database
+        '''
+        for write in self._writeQueue.pending():
+            listId, taskSeriesId, taskId = write['key']
+            db.setTaskCompleted(listId, taskSeriesId, taskId, write['completed'])
+
+    def _sendTaskWrite(self, rtmApi, db, write, authManager = None):
+        '''
+        Sends a queued write to RTM (called by the write queue thread).
+        Raises an exception if the write must be sent again later.
+        '''
+        method = write['method']
+        listId, taskSeriesId, taskId = write['key']
+        try:
+            with rtmApi.priority(RequestScheduler.PRIORITY_PREVIEW):
+                result = getattr(rtmApi.rtm.tasks, method)(timeline = self._getTimeline(rtmApi),
+                                                          **write['args'])
+        except RtmException, e:
+            # The timeline might be the problem, use a new one next time
+            self._timeline = None
+            if e.code in self.RETRY_ERROR_CODES:
+                # The next search asks for a new authorization
+                if authManager is not None:
+                    authManager.invalidateOnAuthError(rtmApi, e)
+                raise
+            print "Unable to {} task {}: {}".format(method, taskId, e)
+            if not self._writeQueue.hasLaterWrites(write):
+                db.setTaskCompleted(listId, taskSeriesId, taskId, write['previous'])
+            return
+        if self._writeQueue.hasLaterWrites(write):
+            return
+        # Store the completion time set by RTM
+        for taskseries in result.list:
+            for task in taskseries:
+                if task.id == taskId:
+                    db.setTaskCompleted(listId, taskSeriesId, taskId, task.completed)
+
+    def _getTimeline(self, rtmApi):
+        '''
+        Returns the timeline used for all the write operations, created the
+        first time it is needed
+        (see http://www.rememberthemilk.com/services/api/timelines.rtm)
         '''
-        # The operation requires a timeline
-        result = rtmApi.rtm.timelines.create()
-        timeline = result.timeline.value
-        # Uncomplete task
-        rtmApi.rtm.tasks.uncomplete(timeline = timeline,
-                                  list_id = listId,
-                                  taskseries_id = taskSeriesId,
-                                  task_id = taskId)
+        with self._timelineLock:
+            if self._timeline is None:
+                result = rtmApi.rtm.timelines.create()
+                self._timeline = result.timeline.id
+            return self._timeline
 
     def refreshTasks(self):
         '''
@@ -0,0 +1,189 @@
+#! /usr/bin/python
+
+#    Copyright (c) 2013 Vincenzo Pii <vinc.pii@gmail.com>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version, with the following additional
+#    restriction:
+#    you cannot modify or redistribute this software if you don't use your
+#    own Remember The Milk API Key and Shared Secret pair, or receive explicit
+#    permission from the author (<vinc.pii@gmail.com>) to include your
+#    changes to the code.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#    This product uses the Remember The Milk API but is not endorsed or
+#    certified by Remember The Milk.
+
+
+
+import json
+import os
+import threading
+from collections import deque
+from timeit import default_timer
+
+class _NullSpan(object):
+    '''
+    Span used when the timings are disabled: does nothing
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    def __init__(self, timings, name):
+        self._timings = timings
+        self._name = name
+
+    def __enter__(self):
+        self._start = default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._timings.record(self._name, default_timer() - self._start)
+        if exc_type is not None:
+            self._timings.count(self._name + '.errors')
+        return False
+
+
+class Timings(object):
+    '''
+    This class collects the duration of the stages of the lens (searches,
+    previews, RTM calls...) and counts events, to find out what makes the
+    dash slow.
+
+    The last WINDOW durations of each stage are kept to compute the
+    percentiles. When disabled, span() returns a shared object doing
+    nothing, so the instrumented code is almost as fast as without it.
+    '''
+
+    # Number of durations kept for each stage
+    WINDOW = 1000
+
+    def __init__(self, enabled = False, window = WINDOW):
+        super(Timings, self).__init__()
+
+        self.enabled = enabled
+
+        self._window = window
+
+        # Stage name -> durations (seconds), most recent last
+        self._durations = {}
+
+        # Stage name -> [number of spans, total duration] since the start
+        self._totals = {}
+
+        # Counter name -> value
+        self._counters = {}
+
+        self._lock = threading.Lock()
+
+    def span(self, name):
+        '''
+        Returns a context manager measuring the duration of the with block
+        as a stage called name, e.g.:
+        with timings.span('search.query'):
+            ...
+        '''
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def record(self, name, seconds):
+        '''
+        Adds the duration of a stage
+        '''
+        if not self.enabled:
+            return
+        with self._lock:
+            durations = self._durations.get(name)
+            if durations is None:
+                durations = self._durations[name] = deque(maxlen = self._window)
+                self._totals[name] = [0, 0.0]
+            durations.append(seconds)
+            totals = self._totals[name]
+            totals[0] += 1
+            totals[1] += seconds
+
+    def count(self, name, increment = 1):
+        '''
+        Increases a counter
+        '''
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + increment
+
+    def stats(self):
+        '''
+        Returns a dictionary with:
+        "stages": for each stage, the number of spans ("count"), their
+        average duration ("mean") and, for the last WINDOW spans, the
+        percentiles ("p50", "p95", "p99") and the maximum ("max"), in
+        milliseconds
+        "counters": the value of each counter
+        '''
+        with self._lock:
+            durations = dict((name, sorted(values)) for name, values in self._durations.items())
+            totals = dict((name, list(values)) for name, values in self._totals.items())
+            counters = dict(self._counters)
+        stages = {}
+        for name, values in durations.items():
+            count, total = totals[name]
+            stages[name] = {"count": count,
+                            "mean": total / count * 1000,
+                            "p50": self._percentile(values, 50) * 1000,
+                            "p95": self._percentile(values, 95) * 1000,
+                            "p99": self._percentile(values, 99) * 1000,
+                            "max": values[-1] * 1000}
+        return {"stages": stages, "counters": counters}
+
+    def _percentile(self, sortedValues, percent):
+        # Nearest rank
+        index = max(0, (len(sortedValues) * percent + 99) // 100 - 1)
+        return sortedValues[index]
+
+    def dump(self, statsFile):
+        '''
+        Writes the stats (see stats()) to a JSON file
+        '''
+        statsFile = os.path.expanduser(statsFile)
+        folder = os.path.dirname(statsFile)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        temporaryFile = statsFile + '.tmp'
+        with open(temporaryFile, 'w') as f:
+            json.dump(self.stats(), f, indent = 2, sort_keys = True)
+        os.rename(temporaryFile, statsFile)
+
+    def rtmObserver(self, method, waited, elapsed, error):
+        '''
+        Observer of the RTM calls (see rtmapi.Rtm): records the time spent
+        waiting for the rate limit and the duration of each method
+        '''
+        self.record('rtm.wait', waited)
+        self.record('rtm.' + method, elapsed)
+        if error is not None:
+            self.count('rtm.errors')
+
+    def ingestObserver(self, ingestStats):
+        '''
+        Observer of the bulk inserts of the database (see
+        TasksDB.ingestObserver): records their duration and counts the rows
+        '''
+        self.record('db.ingest.' + ingestStats['table'], ingestStats['seconds'])
+        self.count('db.ingest.' + ingestStats['table'] + '.rows', ingestStats['rows'])
@@ -0,0 +1,220 @@
+#! /usr/bin/python
+
+#    Copyright (c) 2013 Vincenzo Pii <vinc.pii@gmail.com>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version, with the following additional
+#    restriction:
+#    you cannot modify or redistribute this software if you don't use your
+#    own Remember The Milk API Key and Shared Secret pair, or receive explicit
+#    permission from the author (<vinc.pii@gmail.com>) to include your
+#    changes to the code.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#    This product uses the Remember The Milk API but is not endorsed or
+#    certified by Remember The Milk.
+
+
+
+import json
+import os
+import threading
+
+class WriteQueue(object):
+    '''
+    This class keeps the changes made locally that still have to be sent to
+    Remember The Milk (write-behind): they are stored in a file, so that
+    none of them is lost if the lens is closed or RTM can't be reached, and
+    sent in order by a background thread.
+
+    Each write is a dictionary with (at least) these keys:
+    'method': name of the rtm.tasks method (e.g. 'complete')
+    'args': arguments of the method (without the timeline)
+    'key': identifies the object changed by the write (e.g. the task ids)
+    '''
+
+    # File where the pending writes are stored, next to the token
+    QUEUE_FILE = os.getenv('HOME') + "/.config/remember-the-lens/pending_writes.json"
+
+    # Maximum number of writes sent in a row, between two saves of the file
+    BATCH_SIZE = 10
+
+    # Time to wait before sending again after a failure (in seconds),
+    # doubled at every failure up to MAX_RETRY_DELAY
+    MIN_RETRY_DELAY = 5
+    MAX_RETRY_DELAY = 600
+
+    # Pairs of writes cancelling each other
+    OPPOSITE_METHODS = {'complete': 'uncomplete', 'uncomplete': 'complete'}
+
+    def __init__(self, queueFile = None):
+        '''
+        queueFile: file storing the pending writes, None to keep them in
+        memory only
+        '''
+        super(WriteQueue, self).__init__()
+
+        self._queueFile = queueFile
+
+        # Pending writes, in the order they have to be sent
+        self._writes = self._load()
+
+        # Identifier of the next write
+        self._nextId = max([write['id'] for write in self._writes] + [0]) + 1
+
+        # Identifiers of the writes being sent
+        self._sending = set()
+
+        # True when the writes must be sent without waiting for the retry delay
+        self._kicked = False
+
+        self._condition = threading.Condition(threading.Lock())
+        self._thread = None
+
+    def _load(self):
+        '''
+        Reads the writes left by the last session
+        '''
+        if self._queueFile is None:
+            return []
+        try:
+            f = open(self._queueFile)
+        except IOError:
+            return []
+        try:
+            return json.load(f)
+        except ValueError, e:
+            print "Discarding the unreadable pending writes: ", e
+            return []
+        finally:
+            f.close()
+
+    def _save(self):
+        '''
+        Stores the pending writes (the file is replaced atomically, so it is
+        never left half written)
+        '''
+        if self._queueFile is None:
+            return
+        folder = os.path.dirname(self._queueFile)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        temporaryFile = self._queueFile + '.tmp'
+        f = open(temporaryFile, 'w')
+        try:
+            json.dump(self._writes, f)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(temporaryFile, self._queueFile)
+
+    def add(self, write):
+        '''
+        Appends a write to the queue. If it cancels a pending write of the
+        same object (e.g. uncomplete after complete), both are dropped.
+        '''
+        with self._condition:
+            opposite = self.OPPOSITE_METHODS.get(write['method'])
+            for pending in reversed(self._writes):
+                if pending['key'] != write['key']:
+                    continue
+                if pending['method'] == opposite and pending['id'] not in self._sending:
+                    self._writes.remove(pending)
+                    self._save()
+                    return
+                break
+            write = dict(write, id = self._nextId)
+            self._nextId += 1
+            self._writes.append(write)
+            self._save()
+            self._kicked = True
+            self._condition.notify_all()
+
+    def pending(self):
+        '''
+        Returns the writes not sent yet, in order
+        '''
+        with self._condition:
+            return list(self._writes)
+
+    def hasLaterWrites(self, write):
+        '''
+        Returns True if a write queued after the given one changes the same
+        object
+        '''
+        with self._condition:
+            return any(pending['key'] == write['key'] and pending['id'] > write['id']
+                       for pending in self._writes)
+
+    def kick(self):
+        '''
+        Sends the pending writes now, without waiting for the retry delay
+        (e.g. because RTM has just been reached)
+        '''
+        with self._condition:
+            self._kicked = True
+            self._condition.notify_all()
+
+    def start(self, sender, listener = None):
+        '''
+        Starts the thread sending the writes (the first time it is called).
+
+        sender(write) makes the RTM call: it returns when the write is done
+        (or rejected by RTM, so it must not be sent again) and raises an
+        exception if it has to be sent again later.
+        listener, if not None, is called (in the same thread) after some
+        writes have been sent.
+        '''
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target = self._sendWrites, args = (sender, listener))
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _sendWrites(self, sender, listener):
+        delay = 0
+        while True:
+            with self._condition:
+                while len(self._writes) == 0:
+                    self._condition.wait()
+                if delay > 0 and not self._kicked:
+                    # Waiting for the network, unless something new happens
+                    self._condition.wait(delay)
+                self._kicked = False
+                batch = self._writes[:self.BATCH_SIZE]
+                self._sending = set(write['id'] for write in batch)
+
+            sent = []
+            error = None
+            for write in batch:
+                try:
+                    sender(write)
+                except Exception, e:
+                    error = e
+                    break
+                sent.append(write['id'])
+
+            with self._condition:
+                self._writes = [write for write in self._writes if write['id'] not in sent]
+                self._sending = set()
+                if len(sent) > 0:
+                    self._save()
+
+            if len(sent) > 0 and listener is not None:
+                listener()
+            if error is None:
+                delay = 0
+            else:
+                delay = min(max(delay * 2, self.MIN_RETRY_DELAY), self.MAX_RETRY_DELAY)
+                print "Unable to send the pending writes ({}), retrying in {} seconds".format(error, delay)
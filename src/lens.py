@@ -31,16 +31,23 @@ from AuthManager import AuthManager
 from ListsInfoManager import ListsInfoManager
 from TasksDB import TasksDB
 from TasksInfoManager import TasksInfoManager
+from TaskRenderCache import TaskRenderCache
+from Timings import Timings
+from SearchNarrowingCache import SearchNarrowingCache
+from SearchRanker import SearchRanker
 from TokenManager import TokenManager
+from WriteQueue import WriteQueue
 from datetime import datetime, timedelta
 from gi.repository import GLib, Gio, GObject, Unity, Unity
-from rtmapi import Rtm
+from rtmapi import Rtm, RequestScheduler
 from singlet.lens import SingleScopeLens, ListViewCategory
 from singlet.utils import run_lens
 from time import time, timezone, altzone, localtime
 import gettext
 import locale
+import os
 import sys
+import threading
 import webbrowser
 
 def init_localization():
@@ -63,6 +70,12 @@ RAK = "b2d2254113dd2cd9dc773a62c5a9e337"
 RSS = "733e05a324352a7d"
 
 RTM_PAGE="http://www.rememberthemilk.com"
+# Base URL of a service replacing RTM (e.g. bench/rtmserver.py), if any
+RTM_SERVICE_URL = os.getenv('REMEMBER_THE_LENS_RTM_URL')
+# File where the timings of the lens are written (disabled if not set)
+STATS_FILE = os.getenv('REMEMBER_THE_LENS_STATS')
+# Time between two updates of the stats file (in seconds)
+STATS_DUMP_INTERVAL = 30
 ICON="/usr/share/unity/lenses/tasks-lens/rtl"
 ICON_EXTENSION = ".png"
 
@@ -85,41 +98,29 @@ class TasksLens(SingleScopeLens):
         icon = 'tasks.svg'
         category_order = ['tasks']
         filter_order = ['categoryFilter', 'displayedFieldsFilter', 'orderFilter', 'completedFilter']
+        # Searches must not block the main loop while waiting for RTM
+        async_search = True
+        # Fold keystrokes and filter toggles into one search (milliseconds)
+        search_debounce = 150
+        search_max_wait = 600
+        # Display the first results at once, even for thousands of tasks,
+        # the others follow while the main loop is idle. Without a phrase,
+        # the first page is read and rendered before the other tasks.
+        search_first_page = 60
+        search_page_budget = 15
+        search_first_page_wait = 100
 
     tasks = ListViewCategory(_(u"Tasks").decode('utf-8'), 'stock_yes')
 
     # id, display name, icon, contracted state
     categoryFilter = Unity.RadioOptionFilter.new("categoryFilter", _(u"Sections").decode('utf-8'), None, False)
 
-    # Get the lists names if possible
-    catNames = ListsInfoManager.getTheCategoriesListStatically(RAK, RSS)
-
-    # Maps a filter id to the corresponding string to which fitering must be
-    # applied. This is necessary to support different languages
-    # e.g.: '0': 'Inbox',
-    #       '1': 'Work',
-    #       '2': 'Personal',
-    #       '3': 'Study',
-    #       '4': 'Sent'
-    categoryIdToNameMappingTable = {}
-
     PRIORITIES = {'0': _(u'Oops, error!').decode('utf-8'),
                   '1': _(u'High Priority').decode('utf-8'),
                   '2': _(u'Medium Priority').decode('utf-8'),
                   '3': _(u'Low Priority').decode('utf-8'),
                   'N': _(u'Unspecified').decode('utf-8')}
 
-    # Populate the category map
-    for i in range(0, len(catNames)):
-        categoryIdToNameMappingTable[str(i)] = catNames[i]
-
-    # Populate the category filters
-    if len(categoryIdToNameMappingTable) == 0:
-        categoryFilter.add_option('0', _(u"Lens restart needed").decode('utf-8'), None)
-    else:
-        for i in range(0, len(categoryIdToNameMappingTable)):
-            categoryFilter.add_option(categoryIdToNameMappingTable.keys()[i], categoryIdToNameMappingTable.values()[i], None)
-
     # Populate the ID filters
     displayedFieldsFilter = Unity.CheckOptionFilter.new("fieldsFilter", _(u"Fields to display").decode('utf-8'), None, False) 
     displayedFieldsFilter.add_option(CATEGORY_FIELD_FILTER_ID, _(u"Category").decode('utf-8'), None)
@@ -149,14 +150,23 @@ class TasksLens(SingleScopeLens):
 
     # Minimum characters to filter results using the search bar
     MIN_SEARCH_LENGTH = 3
+
+    # Maximum number of results of a search (the best ones are displayed)
+    SEARCH_RESULTS_LIMIT = 100
+
+    # Maximum number of fuzzy results scored, when the results matching the
+    # search are not enough
+    FUZZY_CANDIDATES_LIMIT = 200
     def __init__ (self):
         super(TasksLens, self).__init__()
 
         # Object to manage RTM lists
         self._listsInfoManager = ListsInfoManager()
 
-        # Object to manage RTM tasks
-        self._tasksInfoManager = TasksInfoManager(self._listsInfoManager)
+        # Object to manage RTM tasks, the changes to be sent to RTM are
+        # kept in a file until they are sent
+        self._tasksInfoManager = TasksInfoManager(self._listsInfoManager,
+                                                  WriteQueue(WriteQueue.QUEUE_FILE))
 
         # Object to handle the token (save to file, read from file)
         self._tokenManager = TokenManager()
@@ -167,16 +177,67 @@ class TasksLens(SingleScopeLens):
         # RTM auth token
         self._token = self._tokenManager.readTokenFromFile()
 
+        # Duration of the stages of searches, previews and RTM calls
+        self._timings = Timings(STATS_FILE is not None)
+        if self._timings.enabled:
+            GLib.timeout_add_seconds(STATS_DUMP_INTERVAL, self._dumpTimings)
+
         # RTM object
-        self._rtm = Rtm(RAK, RSS, "write", self._token)
+        if RTM_SERVICE_URL is None:
+            self._rtm = Rtm(RAK, RSS, "write", self._token)
+        else:
+            print "Using the RTM service at {}".format(RTM_SERVICE_URL)
+            self._rtm = Rtm(RAK, RSS, "write", self._token,
+                            base_url = RTM_SERVICE_URL.rstrip('/') + '/services/rest/',
+                            auth_url = RTM_SERVICE_URL.rstrip('/') + '/services/auth/')
+        if self._timings.enabled:
+            self._rtm.observer = self._timings.rtmObserver
         
-        # Database
-        self._db = TasksDB()
+        # Database (persistent, so the cached tasks are available at startup)
+        self._db = TasksDB(TasksDB.DB_FILE)
+        if self._timings.enabled:
+            self._db.ingestObserver = self._timings.ingestObserver
         
         # The user's current system timezone offset
         tzoffset = timezone if not localtime().tm_isdst else altzone
         self._tzoffset = timedelta(seconds = tzoffset * -1)
 
+        # What is displayed for each task, computed again only when it changes
+        self._renderCache = TaskRenderCache(ICON, ICON_EXTENSION, self._tzoffset)
+        self._db.addChangeListener(self._renderCache.invalidate)
+
+        # Result URI -> task dictionary, for the tasks displayed by the
+        # searches, so that previews don't need to query the database
+        self._previewIndex = {}
+        self._db.addChangeListener(self._invalidatePreviewIndex)
+
+        # Results of the last searches, narrowed down while the user types
+        self._narrowingCache = SearchNarrowingCache()
+
+        # Orders the results of the searches by relevance
+        self._ranker = SearchRanker()
+
+        # Send the task changes made offline (also by the last session)
+        self._tasksInfoManager.startWriteQueue(self._rtm, self._db, self._onTaskWritten,
+                                               self._authManager)
+
+        # True while the tasks are being downloaded in background
+        self._refreshing = False
+        self._refreshLock = threading.Lock()
+
+        # Maps a filter id to the corresponding string to which fitering must be
+        # applied. This is necessary to support different languages
+        # e.g.: '0': 'Inbox',
+        #       '1': 'Work',
+        #       '2': 'Personal',
+        #       '3': 'Study',
+        #       '4': 'Sent'
+        self.categoryIdToNameMappingTable = {}
+
+        # The categories come from the lists stored by the last session,
+        # they are updated every time the lists are downloaded
+        self._updateCategoryFilter()
+
     #
     # Update results model (currently disabled)
     #
@@ -188,20 +249,21 @@ class TasksLens(SingleScopeLens):
     # Update results model
     #
     def search(self, search, model):
-        self._handleSearch(search, model)
+        self._handleSearch(search, model, self.get_search_state(), None)
+        return
+
+    def search_async(self, search, model, state, cancellable):
+        self._handleSearch(search, model, state, cancellable)
         return
 
-    def _handleSearch(self, search, model):
+    def get_search_state(self):
         """
-        Handles search operations on the lens
+        Reads the status of the filters, returns a tuple with:
+        filteredCategory: name of the category (list) to be displayed (None for all)
+        showCompleted: True if completed tasks must be displayed
+        optionalDisplayFields: contains elements of this set: ("category", "due", "priority")
+        orderBy: priority, due date or name
         """
-        # Authenticate if necessary
-        if self._authManager.checkAndRequireAuthentication(self._rtm, model) == True:
-            return
-
-        # Download the tasks list
-        self._tasksInfoManager.downloadTasksList(self._rtm, self._db)
-        
         # Get the category to be displayed (if None, display them all)
         try:
             filteredCategoryId = self._scope.get_filter('categoryFilter').get_active_option().props.id
@@ -229,72 +291,264 @@ class TasksLens(SingleScopeLens):
             orderBy = self._scope.get_filter('orderingFilter').get_active_option().props.id
         except (AttributeError):
             orderBy = None
-        
-        # Filters at this point:
-        # filteredCategoryId: id of the category (list id) to be displayed
-        # orderBy: priority, due date or name
-        # optionalDisplayFields:  contains elements of this set: ("category", "due", "priority")
-        
-        # get the tasks of the specified category (if not None), ordered on orderBy
-        # and also completed tasks if required
-        tasks = self._db.getTasks(filteredCategory, orderBy, showCompleted)
-
-        for taskDictionary in tasks:
-            categoryName = taskDictionary[TasksDB.TCATEGORY] if CATEGORY_FIELD_FILTER_ID in optionalDisplayFields else ""
-            dueTime = self._prettyFormatDueDate(taskDictionary[TasksDB.TDUE]) if DUE_FIELD_FILTER_ID in optionalDisplayFields else ""
-            priority = taskDictionary[TasksDB.TPRIORITY] if PRIORITY_FIELD_FILTER_ID in optionalDisplayFields else "N"
-            name = taskDictionary[TasksDB.TNAME]
-            listId = taskDictionary[TasksDB.TLIST_ID]
-            taskseriesId = taskDictionary[TasksDB.TSERIES_ID]
-            taskId = taskDictionary[TasksDB.TID]
-            completed = taskDictionary[TasksDB.TCOMPLETED]
-            self._updateModel(categoryName, name, dueTime, priority, search, model, listId, taskseriesId, taskId, completed)
-
-    def _updateModel(self, categoryName, taskName, due, priority, search, model, listId, taskseriesId, taskId, completed):
-        if len(due) > 0:
-            due = ' ' + '[' + due + ']'
-        
-        icon = self._getIconForTask(priority, completed)
 
-        if len(search) < self.MIN_SEARCH_LENGTH or search.lower() in taskName.lower():
-            model.append('rtmLens://select/lid={}&tsid={}&tid={}'.format(listId, taskseriesId, taskId),
-                icon,
-                self.tasks,
-                'text/plain',
-                categoryName + due,
-                taskName,
-                '')
+        return filteredCategory, showCompleted, optionalDisplayFields, orderBy
+
+    def get_search_key(self, search, state):
+        """
+        Searches with the same filters, the same phrase, the same tasks and
+        the same token display the same results. Searches which may authenticate or
+        download the tasks are always run.
+        """
+        if self._rtm.token is None or self._tasksInfoManager.isDownloadNeeded(self._db):
+            return None
+        # Short search strings display every task
+        if len(search) < self.MIN_SEARCH_LENGTH:
+            search = None
+        elif self._db.searchWords(search) is not None:
+            # Searched word by word: the case, the diacritics and the
+            # separators don't change the results
+            search = TasksDB.searchTokens(search)
+        filteredCategory, showCompleted, optionalDisplayFields, orderBy = state
+        return (search, filteredCategory, showCompleted, tuple(optionalDisplayFields),
+                orderBy, self._db.generation, self._rtm.token)
+
+    def _handleSearch(self, search, model, state, cancellable):
+        """
+        Handles search operations on the lens.
+        This runs in a worker thread: tasks are read from the local database
+        and, if they are too old, downloaded again in background.
+        """
+        with self._timings.span('search.total'):
+            self._searchTasks(search, model, state, cancellable)
+
+    def _searchTasks(self, search, model, state, cancellable):
+        # Authenticate if necessary
+        with self._timings.span('search.auth'):
+            if self._authManager.checkAndRequireAuthentication(self._rtm, model) == True:
+                return
+
+        if not self._tasksInfoManager.hasLocalTasks(self._db):
+            # Nothing to display yet, wait for the first download
+            try:
+                with self._timings.span('search.download'):
+                    self._tasksInfoManager.downloadTasksList(self._rtm, self._db)
+            except Exception, e:
+                if self._authManager.invalidateOnAuthError(self._rtm, e):
+                    self._authManager.checkAndRequireAuthentication(self._rtm, model)
+                    return
+                raise
+            GLib.idle_add(self._updateCategoryFilter)
+        elif self._tasksInfoManager.isDownloadNeeded(self._db):
+            # Display the local tasks now, the search is repeated when the
+            # new ones are available
+            self._refreshTasksInBackground()
+
+        if cancellable is not None and cancellable.is_cancelled():
+            self._timings.count('search.cancelled')
+            return
+
+        filteredCategory, showCompleted, optionalDisplayFields, orderBy = state
+        
+        # Short search strings display every task
+        if len(search) < self.MIN_SEARCH_LENGTH:
+            search = None
+
+        # Taken before the tasks are read: if they change meanwhile, the
+        # index is replaced and the outdated tasks don't stay in the new one
+        previewIndex = self._previewIndex
+
+        # get the tasks of the specified category (if not None), ordered on orderBy,
+        # also completed tasks if required and matching the search string
+        with self._timings.span('search.query'):
+            tasks = self._getTasks(filteredCategory, orderBy, showCompleted, search)
+
+        showCategory = CATEGORY_FIELD_FILTER_ID in optionalDisplayFields
+        showDue = DUE_FIELD_FILTER_ID in optionalDisplayFields
+        showPriority = PRIORITY_FIELD_FILTER_ID in optionalDisplayFields
+        rows = 0
+        with self._timings.span('search.model'):
+            # Without a phrase, the tasks are read and rendered on the way
+            for taskDictionary, rendered in tasks:
+                previewIndex[rendered.uri] = taskDictionary
+                categoryName = taskDictionary[TasksDB.TCATEGORY] if showCategory else ""
+                due = rendered.dueLabel if showDue else ""
+                icon = rendered.icon if showPriority else rendered.plainIcon
+                self._updateModel(rendered.uri, icon, categoryName + due, taskDictionary[TasksDB.TNAME], model)
+                rows += 1
+        self._timings.count('search.rows', rows)
+
+    def _getTasks(self, filteredCategory, orderBy, showCompleted, search):
+        '''
+        Returns the (task dictionary, RenderedTask) tuples of the tasks to be
+        displayed. When the phrase extends the previous one, the previous
+        results are filtered instead of querying the database.
+
+        Without search, all the tasks are returned in the chosen order
+        (rendered while they are iterated, see _iterAllTasks), otherwise the
+        best SEARCH_RESULTS_LIMIT ones (see SearchRanker), in the chosen
+        order among those matching the phrase as well.
+        '''
+        # Read first: results computed while the tasks change are outdated
+        key = (filteredCategory, orderBy, showCompleted, self._db.generation)
+        words = self._db.searchWords(search)
+        tasks = self._narrowingCache.lookup(key, search, words)
+        if tasks is not None:
+            self._timings.count('search.narrowed')
+        elif search is None:
+            self._timings.count('search.queried')
+            return self._iterAllTasks(key, filteredCategory, orderBy, showCompleted)
+        else:
+            self._timings.count('search.queried')
+            tasks = [(taskDictionary, self._renderCache.get(taskDictionary))
+                     for taskDictionary in self._db.getTasks(filteredCategory, orderBy, showCompleted, search)]
+        self._narrowingCache.store(key, search, words, tasks)
+        if search is None:
+            return tasks
+
+        with self._timings.span('search.rank'):
+            fuzzyTasks = []
+            if len(tasks) < self.SEARCH_RESULTS_LIMIT:
+                # Not many matches, maybe because of a typo
+                found = set(rendered.uri for taskDictionary, rendered in tasks)
+                for taskDictionary in self._db.getFuzzyTasks(filteredCategory, showCompleted, search,
+                                                             self.FUZZY_CANDIDATES_LIMIT):
+                    rendered = self._renderCache.get(taskDictionary)
+                    if rendered.uri not in found:
+                        fuzzyTasks.append((taskDictionary, rendered))
+            ranked = self._ranker.rank(TasksDB.searchTokens(search), tasks, fuzzyTasks,
+                                       self.SEARCH_RESULTS_LIMIT, time(), orderBy)
+        self._timings.count('search.fuzzy', len(fuzzyTasks))
+        return ranked
+
+    def _iterAllTasks(self, key, filteredCategory, orderBy, showCompleted):
+        '''
+        Yields the (task dictionary, RenderedTask) tuples of all the tasks in
+        the chosen order, rendering them on the way. The first page (see
+        Meta.search_first_page) is read with a query of its own, so that it
+        is displayed without waiting for the others to be read and
+        rendered. Once all of them are yielded, they are stored in the
+        narrowing cache with the key of the search.
+        '''
+        yielded = set()
+        if self._meta.search_first_page > 0:
+            for taskDictionary in self._db.getTasks(filteredCategory, orderBy, showCompleted,
+                                                    limit = self._meta.search_first_page):
+                rendered = self._renderCache.get(taskDictionary)
+                yielded.add(rendered.uri)
+                yield taskDictionary, rendered
+        tasks = []
+        for taskDictionary in self._db.getTasks(filteredCategory, orderBy, showCompleted):
+            rendered = self._renderCache.get(taskDictionary)
+            tasks.append((taskDictionary, rendered))
+            # Without ordering, the first page may not be in the same order
+            if rendered.uri not in yielded:
+                yield taskDictionary, rendered
+        self._narrowingCache.store(key, None, None, tasks)
+
+    def _invalidatePreviewIndex(self, taskSeriesIds):
+        # Called by the database, the indexed tasks might be outdated
+        self._previewIndex = {}
+
+    def _refreshTasksInBackground(self):
+        """
+        Downloads the tasks in a new thread (unless a download is already
+        running) and searches again if they changed
+        """
+        with self._refreshLock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        thread = threading.Thread(target = self._refreshTasks)
+        thread.daemon = True
+        thread.start()
+
+    def _refreshTasks(self):
+        try:
+            # Requests the user is waiting for go first
+            with self._rtm.priority(RequestScheduler.PRIORITY_BACKGROUND):
+                with self._timings.span('refresh.download'):
+                    changed = self._tasksInfoManager.downloadTasksList(self._rtm, self._db)
+        except Exception, e:
+            print "Unable to download the tasks: ", e
+            # Searching again will ask for a new authorization, if needed
+            changed = self._authManager.invalidateOnAuthError(self._rtm, e)
+        finally:
+            self._refreshing = False
+        GLib.idle_add(self._updateCategoryFilter)
+        if changed:
+            GLib.idle_add(self._onTasksChanged)
+
+    def _updateCategoryFilter(self):
+        """
+        Updates the options of the categories filter with the names of the
+        lists stored in the database (runs in the main loop)
+        """
+        names = self._db.getListNames()
+        if names == [self.categoryIdToNameMappingTable[str(i)] for i in range(len(self.categoryIdToNameMappingTable))]:
+            return False
+        categoryFilter = self._meta.filter_dict['categoryFilter']
+        # Keep the selected category, if it still exists
+        active = categoryFilter.get_active_option()
+        activeName = self.categoryIdToNameMappingTable.get(active.props.id) if active is not None else None
+        for filterId in self.categoryIdToNameMappingTable.keys():
+            categoryFilter.remove_option(filterId)
+        self.categoryIdToNameMappingTable = {}
+        for i, name in enumerate(names):
+            self.categoryIdToNameMappingTable[str(i)] = name
+            option = categoryFilter.add_option(str(i), name, None)
+            if name == activeName:
+                option.props.active = True
+        return False
+
+    def _dumpTimings(self):
+        '''
+        Writes the timings to the stats file (runs in the main loop)
+        '''
+        try:
+            self._timings.dump(STATS_FILE)
+        except (IOError, OSError), e:
+            print "Unable to write the stats: ", e
+        return True
+
+    def _onTasksChanged(self):
+        self._scope.queue_search_changed(Unity.SearchType.DEFAULT)
+        return False
+
+    def _updateModel(self, uri, icon, comment, taskName, model):
+        model.append(uri,
+            icon,
+            self.tasks,
+            'text/plain',
+            comment,
+            taskName,
+            '')
 
     def _getIconForTask(self, priority, completed):
         '''
         Returns the file name of the icon to be used for the task with a
         given priority and complete status
         '''
-        if completed == u'':
-            # not completed
-            completed = 'u'
-        else:
-            # completed
-            completed = 'c'
-            
-        icon = ICON + completed + 'p' + priority + ICON_EXTENSION
-        return icon
+        return self._renderCache.iconForTask(priority, completed)
 
     def handle_uri(self, scope, uri):
         action = uri.split('/')[-2]
         word = uri.split('/')[-1]
         print "on_activate_uri: %s %s" % (action, word)
         if action == 'auth':
-            self._token = self._authManager.rtmCompleteAuthentication(self._rtm, self._tokenManager)
-            # Clear results (icon asking for auth)
-            results = self._scope.props.results_model
-            results.clear()
-            # Update the lens by simulating an empty search
-            self.search ("", results)
+            # Getting the token requires RTM, don't wait for it here
+            thread = threading.Thread(target = self._completeAuthentication)
+            thread.daemon = True
+            thread.start()
             return self.update_dash_response()
         elif action == 'select':
             webbrowser.open(RTM_PAGE)
 
+    def _completeAuthentication(self):
+        self._token = self._authManager.rtmCompleteAuthentication(self._rtm, self._tokenManager)
+        # Update the lens (replaces the icon asking for auth)
+        GLib.idle_add(self._onTasksChanged)
+
     def _getTaskIdsFromUri(self, uri):
         '''
         Parses the URI of a model, which contains the three identifiers of
@@ -319,22 +573,21 @@ class TasksLens(SingleScopeLens):
         Callback method called when the preview for an element is requested
         (i.e., someone right-clicked a task) 
         '''
-        # Download the tasks list
-        self._tasksInfoManager.downloadTasksList(self._rtm, self._db)
-        identifiers = self._getTaskIdsFromUri(uri)
-        model = scope.props.results_model
-        current_task = model.get_first_iter()
-        last_task = model.get_last_iter()
-        # Get, from all the elements, the one that was clicked
-        while current_task != last_task:
-            if model.get_value(current_task, 0) == uri:
-                break
-            else:
-                current_task = model.next(current_task)
-        if current_task == last_task:
-            # not found!! something very wrong happened
-            raise ValueError('Unable to load task preview')
-        taskInfo = self._db.getTaskById(identifiers['tid'], identifiers['lid'], identifiers['tsid'])
+        with self._timings.span('preview.total'):
+            return self._buildPreview(uri)
+
+    def _buildPreview(self, uri):
+        # The preview is built from the local tasks only
+        with self._timings.span('preview.lookup'):
+            taskInfo = self._previewIndex.get(uri)
+            if taskInfo is None:
+                self._timings.count('preview.databaseLookups')
+                identifiers = self._getTaskIdsFromUri(uri)
+                try:
+                    taskInfo = self._db.getTaskById(identifiers['tid'], identifiers['lid'], identifiers['tsid'])
+                except ValueError:
+                    # not found!! something very wrong happened
+                    raise ValueError('Unable to load task preview')
         # Title, description (not visible ?!), icon (set later)
         preview = Unity.GenericPreview.new(taskInfo[TasksDB.TCATEGORY], taskInfo[TasksDB.TNAME], None)
         icon = self._getIconForTask(taskInfo[TasksDB.TPRIORITY], taskInfo[TasksDB.TCOMPLETED])
@@ -378,52 +631,33 @@ class TasksLens(SingleScopeLens):
     def complete_task(self, scope, uri):
         print "Completing task...: ", uri
         ids = self._getTaskIdsFromUri(uri)
-        self._tasksInfoManager.markCompleted(self._rtm, ids['lid'], ids['tsid'], ids['tid'])
-        self._tasksInfoManager.refreshTasks()
+        self._tasksInfoManager.markCompleted(self._db, ids['lid'], ids['tsid'], ids['tid'])
+        self._onTasksChanged()
         # http://developer.ubuntu.com/api/ubuntu-12.04/python/Unity-5.0.html#Unity.HandledType
         return Unity.ActivationResponse(handled = Unity.HandledType.SHOW_PREVIEW)#, goto_uri=uri)
 
     def uncomplete_task(self, scope, uri):
         print "Uncompleting task...: ", uri
         ids = self._getTaskIdsFromUri(uri)
-        self._tasksInfoManager.markUncompleted(self._rtm, ids['lid'], ids['tsid'], ids['tid'])
-        self._tasksInfoManager.refreshTasks()
+        self._tasksInfoManager.markUncompleted(self._db, ids['lid'], ids['tsid'], ids['tid'])
+        self._onTasksChanged()
         # http://developer.ubuntu.com/api/ubuntu-12.04/python/Unity-5.0.html#Unity.HandledType
         return Unity.ActivationResponse(handled = Unity.HandledType.SHOW_PREVIEW)
         
+    def _onTaskWritten(self):
+        '''
+        Called (in another thread) when task changes, which were already
+        displayed, have been sent to RTM: the results are updated with the
+        final state
+        '''
+        GLib.idle_add(self._onTasksChanged)
+
     def _prettyFormatDueDate(self, dueDateString):
         '''
         Parses the due date as provided by the service and
         produces a pretty representation
         '''
-        if dueDateString == '':
-            return ''
-
-        # Input format example: 2012-03-29T22:00:00Z
-
-        # Collect the tokens
-        start = 0;
-        firstHyphen = dueDateString.find('-')
-        secondHyphen = dueDateString.rfind('-')
-        bigT = dueDateString.find('T')
-        firstColon = dueDateString.find(':')
-        secondColon = dueDateString.rfind(':')
-        bigZ =  dueDateString.find('Z')
-
-        # Extract the strings
-        year = dueDateString[start : firstHyphen]
-        month = dueDateString[firstHyphen + 1 : secondHyphen]
-        day = dueDateString[secondHyphen + 1 : bigT]
-        hour = dueDateString[bigT + 1 : firstColon]
-        minutes = dueDateString[firstColon + 1 : secondColon]
-        seconds = dueDateString[secondColon + 1 : bigZ]
-
-        # Build the formatted string
-        dt = datetime (int(year), int(month), int(day), int(hour), int(minutes), int(seconds))
-        dt = dt + self._tzoffset
-
-        # E.g. 'Wed 07 Nov 2012 11:09AM'
-        return dt.strftime("%a %d %b %Y %I:%M%p")
+        return self._renderCache.formatDueDate(dueDateString)
 
 if __name__ == "__main__":
     run_lens(TasksLens, sys.argv)
@@ -1,12 +1,39 @@
 import hashlib
-import httplib2
+import threading
+import time
 import urllib
-import xml.etree.ElementTree as ElementTree
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+from collections import namedtuple
+from contextlib import contextmanager
+from cStringIO import StringIO
+from scheduler import RequestScheduler
+from transport import PooledTransport
 
 __author__ = "Michael Gruenewald <mail@michaelgruenewald.eu>"
-__all__ = ('Rtm',)
+__all__ = ('Rtm', 'RequestScheduler', 'TaskRecord', 'ListRecord', 'Response',
+           'List', 'TaskSeries', 'Task', 'Timeline', 'Auth', 'Transaction',
+           'Text', 'decode_response', 'parse_response')
 
-class RtmException(Exception): pass
+"""
+Compact records produced by the streaming decoders. TaskRecord describes
+the first task of a task series (deleted is the deletion time for the
+tasks in the <deleted> section of a rtm.tasks.getList delta, None for
+the others).
+"""
+TaskRecord = namedtuple('TaskRecord', 'list_id taskseries_id task_id completed '
+                                      'name due priority deleted')
+ListRecord = namedtuple('ListRecord', 'id name')
+
+class RtmException(Exception):
+    """
+    @param code: the RTM error code, None if the request failed at HTTP level
+    """
+    def __init__(self, message, code = None):
+        Exception.__init__(self, message)
+        self.code = code
 
 class Rtm(object):
     _auth_url = "http://api.rememberthemilk.com/services/auth/"
@@ -18,13 +45,52 @@ class Rtm(object):
     @param perms: desired access permissions, one of "read", "write"
                   and "delete"
     @param token: token for granted access (optional)
+    @param transport: object making the HTTP requests, with a
+                      request(url, headers) method returning a
+                      (response, body) tuple (default: PooledTransport)
+    @param scheduler: RequestScheduler pacing the requests (default: one
+                      respecting the RTM rate limit)
+    @param base_url: URL of the REST endpoint, to use a service other than
+                     RTM (e.g. a local stand-in)
+    @param auth_url: URL of the authentication page of that service
+    @param observer: function called after every request with the method
+                     name, the seconds waited for the scheduler, the
+                     seconds taken by the request and the exception raised
+                     by the transport (None if it succeeded)
     """
-    def __init__(self, api_key, shared_secret, perms = "read", token = None):
+    def __init__(self, api_key, shared_secret, perms = "read", token = None,
+                 transport = None, scheduler = None, base_url = None, auth_url = None,
+                 observer = None):
         self.api_key = api_key
         self.shared_secret = shared_secret
         self.perms = perms
         self.token = token
-        self.http = httplib2.Http()
+        self.transport = transport or PooledTransport()
+        self.scheduler = scheduler or RequestScheduler()
+        self._local = threading.local()
+        self.observer = observer
+        if base_url is not None:
+            self._base_url = base_url
+        if auth_url is not None:
+            self._auth_url = auth_url
+    
+    """
+    Sets the scheduling priority (see RequestScheduler) of the requests
+    made by the current thread in the with block, e.g.:
+    with rtm.priority(RequestScheduler.PRIORITY_BACKGROUND):
+        rtm.rtm.tasks.getList()
+    """
+    @contextmanager
+    def priority(self, priority):
+        previous = self._current_priority()
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+    
+    def _current_priority(self):
+        return getattr(self._local, "priority", RequestScheduler.PRIORITY_INTERACTIVE)
     
     """
     Authenticate as a desktop application.
@@ -35,7 +101,7 @@ class Rtm(object):
     """
     def authenticate_desktop(self):
         rsp = self._call_method("rtm.auth.getFrob", api_key=self.api_key)
-        frob = rsp.frob.value
+        frob = rsp.frob
         url = self._make_request_url(self._auth_url, api_key=self.api_key,
                                      perms=self.perms, frob=frob)
         return url, frob
@@ -74,7 +140,7 @@ class Rtm(object):
         except RtmException, e:
             self.token = None
             return False
-        self.token = rsp.auth.token.value
+        self.token = rsp.auth.token
         return True
     
     def _call_method(self, method_name, **params):
@@ -82,22 +148,94 @@ class Rtm(object):
         if infos.status != 200:
             raise RtmException("Request %s failed (HTTP). Status: %s, reason: %s" % (
                     method_name, infos.status, infos.reason))
-        rtm_obj = RtmObject(ElementTree.fromstring(data), method_name)
+        rtm_obj = parse_response(data, method_name)
+        # Keep the server time of the response (RFC 1123), e.g. to be used
+        # as last_sync value for the next rtm.tasks.getList call
+        rtm_obj.server_time = infos.get('date')
         if rtm_obj.stat == "fail":
             #raise RtmException, (rtm_obj.err.code, rtm_obj.err.msg)
             raise RtmException("Request %s failed. Status: %s, reason: %s" % (
-                    method_name, rtm_obj.err.code, rtm_obj.err.msg))
+                    method_name, rtm_obj.err.code, rtm_obj.err.msg),
+                    rtm_obj.err.code)
         return rtm_obj
     
+    """
+    Runs independent calls in parallel, e.g.:
+    tasks, lists = rtm.parallel(lambda: rtm.rtm.tasks.getList(),
+                                lambda: rtm.rtm.lists.getList())
+    @returns: list with the result of each call; if a call fails, its
+              exception is raised once all the calls are over
+    """
+    def parallel(self, *calls):
+        results = [None] * len(calls)
+        errors = [None] * len(calls)
+        priority = self._current_priority()
+        def run(index):
+            try:
+                with self.priority(priority):
+                    results[index] = calls[index]()
+            except Exception, e:
+                errors[index] = e
+        threads = [threading.Thread(target=run, args=(index,))
+                   for index in range(1, len(calls))]
+        for thread in threads:
+            thread.start()
+        # The first call runs in the calling thread
+        if calls:
+            run(0)
+        for thread in threads:
+            thread.join()
+        for error in errors:
+            if error is not None:
+                raise error
+        return results
+    
+    def _stream_method_auth(self, method_name, **params):
+        decoder = _decoders.get(method_name)
+        if decoder is None:
+            raise ValueError("No streaming decoder for %s" % method_name)
+        all_params = dict(api_key = self.api_key, auth_token = self.token)
+        all_params.update(params)
+        infos, source = self._open_request(method = method_name, **all_params)
+        if infos.status != 200:
+            source.close()
+            raise RtmException("Request %s failed (HTTP). Status: %s, reason: %s" % (
+                    method_name, infos.status, infos.reason))
+        return RtmStream(decoder, source, method_name, infos.get('date'))
+    
     def _call_method_auth(self, method_name, **params):
         all_params = dict(api_key = self.api_key, auth_token = self.token)
         all_params.update(params)
         return self._call_method(method_name, **all_params)
     
     def _make_request(self, request_url = None, **params):
+        return self._send_request(self.transport.request, request_url, **params)
+    
+    """
+    Like _make_request, but returns a file-like body read on demand, if
+    the transport can (see PooledTransport.open)
+    """
+    def _open_request(self, request_url = None, **params):
+        open_request = getattr(self.transport, "open", None)
+        if open_request is None:
+            infos, data = self._make_request(request_url, **params)
+            return infos, StringIO(data)
+        return self._send_request(open_request, request_url, **params)
+    
+    def _send_request(self, send, request_url = None, **params):
         final_url = self._make_request_url(request_url, **params)
-        return self.http.request(final_url,
-                                 headers={'Cache-Control':'no-cache, max-age=0'})
+        waited = self.scheduler.acquire(self._current_priority())
+        if self.observer is None:
+            return send(final_url, headers={'Cache-Control':'no-cache, max-age=0'})
+        start = time.time()
+        error = None
+        try:
+            return send(final_url, headers={'Cache-Control':'no-cache, max-age=0'})
+        except Exception, e:
+            error = e
+            raise
+        finally:
+            self.observer(params.get("method"), waited, time.time() - start, error)
     
     def _make_request_url(self, request_url = None, **params):
         all_params = params.items() + [("api_sig", self._sign_request(params))]
@@ -127,10 +265,121 @@ class RtmName(object):
     def __call__(self, **params):
         return self.rtm._call_method_auth(self.name, **params)
     
+    """
+    Calls the method decoding the response while it is parsed, see RtmStream.
+    """
+    def stream(self, **params):
+        return self.rtm._stream_method_auth(self.name, **params)
+    
     def __getattr__(self, name):
         return RtmName(self.rtm, "%s.%s" % (self.name, name))
 
 
+class RtmStream(object):
+    """
+    Iterable over the records (see TaskRecord and ListRecord) of a response,
+    decoded incrementally: the XML tree is never built as a whole, every
+    element is discarded once its record has been produced.
+    The response can be iterated once: the body is closed (and released)
+    once the iteration is over.
+    """
+    def __init__(self, decoder, source, name, server_time = None):
+        self._decoder = decoder
+        self._source = source
+        self._name = name
+        self.server_time = server_time
+    
+    def __repr__(self):
+        return "<RtmStream %s>" % self._name
+    
+    def __iter__(self):
+        source, self._source = self._source, None
+        if source is None:
+            return
+        try:
+            for record in self._decoder(source, self._name):
+                yield record
+        finally:
+            source.close()
+
+
+def _check_status(event, element, method_name):
+    # <rsp stat="fail"><err code="..." msg="..."/></rsp>
+    if event == "end" and element.tag == "err":
+        raise RtmException("Request %s failed. Status: %s, reason: %s" % (
+                method_name, element.get("code"), element.get("msg")),
+                element.get("code"))
+
+
+def iter_task_records(source, method_name = "rtm.tasks.getList"):
+    """
+    Decodes a rtm.tasks.getList response from the file-like source.
+    @returns: iterator of TaskRecord
+    """
+    list_element = list_id = None
+    taskseries = None
+    deleted = False
+    first_task = False
+    for event, element in ElementTree.iterparse(source, events=("start", "end")):
+        tag = element.tag
+        if event == "start":
+            if tag == "list":
+                list_element = element
+                list_id = element.get("id")
+            elif tag == "deleted":
+                deleted = True
+            elif tag == "taskseries":
+                taskseries = element
+                first_task = True
+            elif tag == "task" and taskseries is not None:
+                if deleted:
+                    yield TaskRecord(list_id, taskseries.get("id"),
+                                     element.get("id"), None, None, None, None,
+                                     element.get("deleted"))
+                elif first_task:
+                    # Only the first task of a (repeating) task series
+                    yield TaskRecord(list_id, taskseries.get("id"),
+                                     element.get("id"), element.get("completed"),
+                                     taskseries.get("name"), element.get("due"),
+                                     element.get("priority"), None)
+                first_task = False
+        else:
+            if tag == "taskseries":
+                taskseries = None
+                # Free the task series already decoded
+                list_element.clear()
+            elif tag == "deleted":
+                deleted = False
+            elif tag == "list":
+                list_element.clear()
+                list_element = None
+            else:
+                _check_status(event, element, method_name)
+
+
+def iter_list_records(source, method_name = "rtm.lists.getList"):
+    """
+    Decodes a rtm.lists.getList response from the file-like source.
+    @returns: iterator of ListRecord
+    """
+    lists_element = None
+    for event, element in ElementTree.iterparse(source, events=("start", "end")):
+        if event == "start":
+            if element.tag == "lists":
+                lists_element = element
+        elif element.tag == "list" and lists_element is not None:
+            yield ListRecord(element.get("id"), element.get("name"))
+            lists_element.clear()
+        else:
+            _check_status(event, element, method_name)
+
+
+_decoders = {
+    "rtm.tasks.getList": iter_task_records,
+    "rtm.lists.getList": iter_list_records,
+}
+
+
 class RtmObject(object):
     _lists = {
         "contacts": "contact",
@@ -139,13 +388,19 @@ class RtmObject(object):
         "method/arguments": "argument",
         "method/errors": "error",
         "methods": "method",
+        "list": "taskseries",
+        "list/taskseries": "task",
         "list/taskseries/notes": "note",
         "list/taskseries/participants": "participant",
+        "list/taskseries/tags": "tag",
         "list/taskseries/task/tags": "tag",
         "lists": "list",
         "locations": "location",
         "tasks": "list",
         "tasks/list": "taskseries",
+        "tasks/list/taskseries": "task",
+        "tasks/list/deleted": "taskseries",
+        "tasks/list/deleted/taskseries": "task",
         "tasks/list/taskseries/notes": "note",
         "tasks/list/taskseries/participants": "participant",
         "tasks/list/taskseries/tags": "tag",
@@ -155,36 +410,295 @@ class RtmObject(object):
     def __init__(self, element, name):
         self._element = element
         self._name = name
+        self._collection = None
     
     def __repr__(self):
         return ("<RtmObject %s>" % self._name).encode('ascii', 'replace')
     
     def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
         newname = "%s/%s" % (self._name, name)
         if name == "value":
-            return self._element.text
+            value = self._element.text
         elif name in self._element.keys():
-            return self._element.get(name)
+            value = self._element.get(name)
         else:
-            return RtmObject(self._element.find(name), newname)
+            value = RtmObject(self._element.find(name), newname)
+        # Found once, the next accesses don't get here
+        self.__dict__[name] = value
+        return value
     
     def _get_collection(self):
+        if self._collection is not None:
+            return self._collection
+        if self._element is None:
+            # Optional element not present in the response (e.g. <deleted>)
+            self._collection = []
+            return self._collection
         child_name = self._lists.get(self._name.partition("/")[2])
         if child_name is None:
             raise ValueError
         new_name = "%s/%s" % (self._name, child_name)
-        return [RtmObject(element, new_name)
-                for element
-                in self._element.findall(child_name)]
+        self._collection = [RtmObject(element, new_name)
+                            for element
+                            in self._element.findall(child_name)]
+        return self._collection
     
     def __nonzero__(self):
         return True
     
-    def __getitem(self, key):
+    def __getitem__(self, key):
         return self._get_collection()[key]
     
     def __iter__(self):
         return iter(self._get_collection())
     
     def __len__(self):
-        return len(self._get_collection)
+        return len(self._get_collection())
+
+
+class _Record(object):
+    """
+    Base class of the records decoded from the responses (see
+    decode_response). Each subclass lists what it takes from its element:
+    _attributes: XML attributes, stored with the same names
+    _text: name of the field storing the text of the element
+    _items: name of the field storing the collection of the element (the
+            children named by RtmObject._lists for its path)
+    _children: child element name -> field name; children that are
+               collections become lists, the others records or Text
+    Fields without a value are None. Anything else is read from the XML
+    through RtmObject, as a fallback.
+    """
+    __slots__ = ('_element', '_name')
+    _attributes = ()
+    _text = None
+    _items = None
+    _children = {}
+    
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(RtmObject(self._element, self._name), name)
+    
+    def __iter__(self):
+        return iter(getattr(self, self._items) if self._items else ())
+    
+    def __len__(self):
+        return len(getattr(self, self._items)) if self._items else 0
+    
+    def __getitem__(self, key):
+        return getattr(self, self._items)[key]
+    
+    def __nonzero__(self):
+        return True
+    
+    def __repr__(self):
+        return ("<%s %s>" % (type(self).__name__, self._name)).encode('ascii', 'replace')
+
+
+class Text(unicode):
+    """
+    Text of an element without attributes and children (e.g. the frob of
+    rtm.auth.getFrob, the token of rtm.auth.getToken). It can be used as a
+    string, value returns it too, like the value of RtmObject.
+    """
+    __slots__ = ()
+    
+    @property
+    def value(self):
+        return unicode(self)
+
+
+class Task(_Record):
+    __slots__ = ('id', 'due', 'has_due_time', 'added', 'completed', 'deleted',
+                 'priority', 'postponed', 'estimate')
+    _attributes = __slots__
+
+
+class TaskSeries(_Record):
+    """
+    A task series, iterable over its tasks (more than one for repeating
+    tasks)
+    """
+    __slots__ = ('id', 'created', 'modified', 'name', 'source', 'url',
+                 'location_id', 'tasks', 'tags')
+    _attributes = ('id', 'created', 'modified', 'name', 'source', 'url', 'location_id')
+    _items = 'tasks'
+    _children = {'tags': 'tags'}
+    
+    @property
+    def task(self):
+        """
+        The first task of the series
+        """
+        return self.tasks[0] if self.tasks else None
+
+
+class List(_Record):
+    """
+    A list, iterable over its task series. In rtm.tasks.getList deltas,
+    deleted_taskseries contains the deleted tasks.
+    """
+    __slots__ = ('id', 'name', 'deleted', 'locked', 'archived', 'position',
+                 'smart', 'sort_order', 'filter', 'taskseries', 'deleted_taskseries')
+    _attributes = ('id', 'name', 'deleted', 'locked', 'archived', 'position',
+                   'smart', 'sort_order')
+    _items = 'taskseries'
+    _children = {'filter': 'filter', 'deleted': 'deleted_taskseries'}
+
+
+class Timeline(_Record):
+    __slots__ = ('id',)
+    _text = 'id'
+
+
+class User(_Record):
+    __slots__ = ('id', 'username', 'fullname')
+    _attributes = __slots__
+
+
+class Auth(_Record):
+    __slots__ = ('token', 'perms', 'user')
+    _children = {'token': 'token', 'perms': 'perms', 'user': 'user'}
+
+
+class Transaction(_Record):
+    __slots__ = ('id', 'undoable')
+    _attributes = __slots__
+
+
+class Error(_Record):
+    __slots__ = ('code', 'msg')
+    _attributes = __slots__
+
+
+class Response(_Record):
+    """
+    A whole response: the fields used by each method are set, e.g. tasks
+    (a list of List) for rtm.tasks.getList, timeline for
+    rtm.timelines.create
+    """
+    __slots__ = ('stat', 'server_time', 'err', 'frob', 'auth', 'tasks', 'lists',
+                 'list', 'timeline', 'transaction')
+    _attributes = ('stat',)
+    _children = dict((name, name) for name in ('err', 'frob', 'auth', 'tasks', 'lists',
+                                               'list', 'timeline', 'transaction'))
+
+
+_record_types = {
+    "auth": Auth,
+    "err": Error,
+    "list": List,
+    "task": Task,
+    "taskseries": TaskSeries,
+    "timeline": Timeline,
+    "transaction": Transaction,
+    "user": User,
+}
+
+
+def parse_response(data, method_name):
+    """
+    Parses the XML of a response and decodes it (see decode_response).
+    @returns: Response
+    """
+    return decode_response(ElementTree.fromstring(data), method_name)
+
+
+def decode_response(element, method_name):
+    """
+    Decodes the whole <rsp> element of a response into a Response.
+    @returns: Response
+    """
+    return _get_decoder(method_name, "")(element)
+
+
+# (method name, path) -> function decoding the elements found at the path
+_record_decoders = {}
+
+
+def _get_decoder(method_name, path):
+    """
+    Returns the function decoding the elements found at path in the
+    responses of method_name, built once from the record classes and
+    RtmObject._lists: records for the tags in _record_types, lists for the
+    collections, Text for the elements without attributes and children,
+    RtmObject for the rest.
+    """
+    key = (method_name, path)
+    decoder = _record_decoders.get(key)
+    if decoder is not None:
+        return decoder
+    name = "%s/%s" % (method_name, path) if path else method_name
+    tag = path.rpartition("/")[2]
+    child_name = RtmObject._lists.get(path)
+    cls = Response if not path else _record_types.get(tag)
+    if cls is not None and (child_name is None or cls._items is not None):
+        decoder = _record_decoder(cls, method_name, name, path)
+    elif child_name is not None:
+        item_decoder = _get_decoder(method_name, "%s/%s" % (path, child_name))
+        def decoder(element):
+            return [item_decoder(child) for child in element.findall(child_name)]
+    else:
+        def decoder(element):
+            if not element.attrib and not len(element):
+                return Text(element.text) if element.text is not None else None
+            return RtmObject(element, name)
+    _record_decoders[key] = decoder
+    return decoder
+
+
+def _record_decoder(cls, method_name, name, path):
+    """
+    Compiles the decoder of a record class for the elements found at path:
+    a function assigning each field directly, reading the children in a
+    single pass
+    """
+    prefix = path + "/" if path else ""
+    namespace = {"cls": cls, "name": name, "new": object.__new__}
+    lines = ["def decoder(element):",
+             "    record = new(cls)",
+             "    record._element = element",
+             "    record._name = name"]
+    assigned = set()
+    if cls._attributes:
+        lines.append("    get = element.get")
+        for field in cls._attributes:
+            lines.append("    record.%s = get(%r)" % (field, field))
+            assigned.add(field)
+    if cls._text is not None:
+        lines.append("    record.%s = element.text" % cls._text)
+        assigned.add(cls._text)
+    # Child tag -> (field, decoder, True if the field is a list of them)
+    children = {}
+    item_name = RtmObject._lists.get(path)
+    if cls._items is not None:
+        lines.append("    record.%s = []" % cls._items)
+        assigned.add(cls._items)
+        if item_name is not None:
+            children[item_name] = (cls._items, _get_decoder(method_name, prefix + item_name), True)
+    for tag, field in sorted(cls._children.items()):
+        children[tag] = (field, _get_decoder(method_name, prefix + tag), False)
+        # Missing collections are empty
+        lines.append("    record.%s = %s" % (field, "[]" if prefix + tag in RtmObject._lists else "None"))
+        assigned.add(field)
+    for field in cls.__slots__:
+        if field not in assigned:
+            lines.append("    record.%s = None" % field)
+    if children:
+        lines.append("    for child in element:")
+        lines.append("        tag = child.tag")
+        keyword = "if"
+        for index, (tag, (field, decoder, is_item)) in enumerate(sorted(children.items())):
+            namespace["decode_%d" % index] = decoder
+            lines.append("        %s tag == %r:" % (keyword, tag))
+            if is_item:
+                lines.append("            record.%s.append(decode_%d(child))" % (field, index))
+            else:
+                lines.append("            record.%s = decode_%d(child)" % (field, index))
+            keyword = "elif"
+    lines.append("    return record")
+    exec compile("\n".join(lines), "<%s decoder>" % cls.__name__, "exec") in namespace
+    return namespace["decoder"]
@@ -0,0 +1,87 @@
+import heapq
+import itertools
+import threading
+import time
+
+__all__ = ('RequestScheduler',)
+
+
+class RequestScheduler(object):
+    """
+    Paces the requests to stay under the RTM rate limit (an average of one
+    request per second, with short bursts allowed), using a token bucket.
+
+    Requests waiting for a token are served by priority (lowest value
+    first) and, with the same priority, in arrival order, so interactive
+    requests pre-empt the queued background ones.
+
+    @param rate: tokens added to the bucket each second
+    @param burst: maximum number of tokens in the bucket
+    """
+    PRIORITY_INTERACTIVE = 0
+    PRIORITY_PREVIEW = 1
+    PRIORITY_BACKGROUND = 2
+
+    def __init__(self, rate = 1.0, burst = 3, clock = time.time):
+        self.rate = float(rate)
+        self.burst = burst
+        self._clock = clock
+        self._tokens = float(burst)
+        self._last_refill = clock()
+        self._waiting = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition(threading.Lock())
+        self._stats = {}
+
+    """
+    Blocks until the caller can make a request.
+    @returns: seconds spent waiting
+    """
+    def acquire(self, priority = PRIORITY_INTERACTIVE):
+        start = self._clock()
+        with self._condition:
+            entry = (priority, next(self._counter))
+            heapq.heappush(self._waiting, entry)
+            while True:
+                self._refill()
+                if self._waiting[0] == entry:
+                    if self._tokens >= 1:
+                        break
+                    # First in line, wait for the next token
+                    self._condition.wait((1 - self._tokens) / self.rate)
+                else:
+                    # Woken up when the first in line takes its token
+                    self._condition.wait(1 / self.rate)
+            heapq.heappop(self._waiting)
+            self._tokens -= 1
+            waited = self._clock() - start
+            self._record(priority, waited)
+            self._condition.notify_all()
+        return waited
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def _record(self, priority, waited):
+        stats = self._stats.setdefault(priority, {"requests": 0, "waitTotal": 0.0, "waitMax": 0.0})
+        stats["requests"] += 1
+        stats["waitTotal"] += waited
+        stats["waitMax"] = max(stats["waitMax"], waited)
+
+    """
+    @returns: dictionary with the number of queued requests ("queued") and,
+              for each priority, the number of requests made and the total
+              and maximum seconds they waited ("priorities")
+    """
+    def stats(self):
+        with self._condition:
+            priorities = dict((priority, dict(stats))
+                              for priority, stats in self._stats.items())
+            for priority, stats in priorities.items():
+                stats["waitAverage"] = stats["waitTotal"] / stats["requests"]
+            queued = {}
+            for priority, _ in self._waiting:
+                queued[priority] = queued.get(priority, 0) + 1
+            return {"queued": queued, "priorities": priorities}
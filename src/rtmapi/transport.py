@@ -0,0 +1,234 @@
+import httplib
+import socket
+import threading
+import urlparse
+import zlib
+
+try:
+    import httplib2
+except ImportError:
+    httplib2 = None
+
+__all__ = ('HttpResponse', 'PooledTransport', 'ResponseBody', 'Httplib2Transport')
+
+
+class HttpResponse(object):
+    """
+    Response returned by the transports.
+
+    @param status: HTTP status code
+    @param reason: HTTP reason phrase
+    @param headers: dictionary of headers, with lowercase names
+    """
+    def __init__(self, status, reason, headers):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+
+    def get(self, name, default = None):
+        return self.headers.get(name.lower(), default)
+
+
+class PooledTransport(object):
+    """
+    HTTP transport keeping the connections alive between requests.
+
+    Idle connections are pooled per host and shared by all the threads, so
+    independent requests can be made in parallel. Responses are requested
+    gzip compressed.
+
+    @param connect_timeout: seconds to wait for a connection
+    @param read_timeout: seconds to wait for data from an open connection
+    @param max_idle: maximum number of idle connections kept for each host
+    """
+    def __init__(self, connect_timeout = 10, read_timeout = 30, max_idle = 4):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    """
+    Makes a GET request.
+    @returns: (HttpResponse, body) tuple
+    """
+    def request(self, url, headers = None):
+        key, connection, response = self._start(url, headers)
+        try:
+            body = response.read()
+        except:
+            connection.close()
+            raise
+        self._finish(key, connection, response)
+
+        if response.getheader("content-encoding", "").lower() == "gzip":
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return HttpResponse(response.status, response.reason,
+                            dict(response.getheaders())), body
+
+    """
+    Makes a GET request without reading the body, which is read (and
+    decompressed) on demand, e.g. by a streaming parser: the whole body is
+    never in memory. The connection is reused once the body has been read
+    to the end, closing the body before closes the connection.
+    @returns: (HttpResponse, file-like body) tuple
+    """
+    def open(self, url, headers = None):
+        key, connection, response = self._start(url, headers)
+        return HttpResponse(response.status, response.reason,
+                            dict(response.getheaders())), \
+               ResponseBody(self, key, connection, response)
+
+    def _start(self, url, headers):
+        """
+        Sends the request, returns the connection key, the connection and
+        the response, with the body still to be read
+        """
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        target = path + ("?" + query if query else "")
+        all_headers = {"Accept-Encoding": "gzip"}
+        all_headers.update(headers or {})
+        key = (scheme, netloc)
+
+        connection = self._get_idle_connection(key)
+        if connection is None:
+            connection = self._new_connection(key)
+            response = self._send(connection, target, all_headers)
+        else:
+            try:
+                response = self._send(connection, target, all_headers)
+            except socket.timeout:
+                raise
+            except (httplib.HTTPException, socket.error):
+                # The server closed the idle connection, retry with a new one
+                connection = self._new_connection(key)
+                response = self._send(connection, target, all_headers)
+        return key, connection, response
+
+    def _finish(self, key, connection, response):
+        """
+        Called once the body of the response has been read
+        """
+        if response.will_close:
+            connection.close()
+        else:
+            self._release_connection(key, connection)
+
+    def _send(self, connection, target, headers):
+        try:
+            if connection.sock is None:
+                connection.connect()
+                connection.sock.settimeout(self.read_timeout)
+            connection.request("GET", target, headers = headers)
+            return connection.getresponse()
+        except:
+            connection.close()
+            raise
+
+    def _new_connection(self, key):
+        scheme, netloc = key
+        if scheme == "https":
+            return httplib.HTTPSConnection(netloc, timeout = self.connect_timeout)
+        return httplib.HTTPConnection(netloc, timeout = self.connect_timeout)
+
+    def _get_idle_connection(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop()
+        return None
+
+    def _release_connection(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    """
+    Closes all the idle connections.
+    """
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+class ResponseBody(object):
+    """
+    File-like body of a response returned by PooledTransport.open,
+    decompressed while it is read
+    """
+
+    # Bytes read from the connection at a time
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, transport, key, connection, response):
+        self._transport = transport
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self._decompressor = None
+        if response.getheader("content-encoding", "").lower() == "gzip":
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        # Decompressed data not returned yet
+        self._pending = ""
+
+    def read(self, size = -1):
+        if size < 0:
+            chunks = []
+            while True:
+                chunk = self.read(self.CHUNK_SIZE)
+                if not chunk:
+                    return "".join(chunks)
+                chunks.append(chunk)
+        while len(self._pending) < size and self._response is not None:
+            self._pending += self._read_chunk()
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+    def _read_chunk(self):
+        try:
+            chunk = self._response.read(self.CHUNK_SIZE)
+        except:
+            self.close()
+            raise
+        if not chunk:
+            # The whole body has been read, the connection can be reused
+            self._transport._finish(self._key, self._connection, self._response)
+            self._response = None
+            if self._decompressor is not None:
+                return self._decompressor.flush()
+            return ""
+        if self._decompressor is not None:
+            return self._decompressor.decompress(chunk)
+        return chunk
+
+    def close(self):
+        if self._response is not None:
+            # The rest of the body can't be skipped
+            self._connection.close()
+            self._response = None
+
+
+class Httplib2Transport(object):
+    """
+    HTTP transport based on httplib2 (optional dependency). httplib2.Http
+    objects can't be shared between threads, so each thread has its own.
+
+    @param timeout: seconds to wait for the connection and for data
+    """
+    def __init__(self, timeout = None):
+        if httplib2 is None:
+            raise ImportError("httplib2 is not available")
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def request(self, url, headers = None):
+        http = getattr(self._local, "http", None)
+        if http is None:
+            http = self._local.http = httplib2.Http(timeout = self.timeout)
+        return http.request(url, headers = headers)
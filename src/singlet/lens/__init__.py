@@ -1,5 +1,6 @@
 from singlet.lens.base import (
     Lens,
+    ResultRows,
     SingleScopeLens,
 )
 
@@ -8,3 +9,7 @@ from singlet.lens.category import (
     IconViewCategory,
     ListViewCategory,
 )
+
+from singlet.lens.model import (
+    ModelDiff,
+)
@@ -18,6 +18,8 @@
 
 import sys
 import os
+import threading
+import traceback
 
 from gi.repository import GLib, GObject, Gio
 from gi.repository import Dee
@@ -26,6 +28,8 @@ from gi.repository import Dee
 _m = dir(Dee.SequenceModel)
 from gi.repository import Unity
 
+from singlet.lens.model import ModelDiff
+
 
 class LensBuilder(type):
     '''
@@ -96,6 +100,23 @@ class LensMeta(object):
         self.scope_order = getattr(meta, 'scope_order', [])
 
         self.search_on_blank = getattr(meta, 'search_on_blank', False)
+        # Run searches in a worker thread (see SingleScopeLens.search_async)
+        self.async_search = getattr(meta, 'async_search', False)
+        # Search and filter events closer than search_debounce milliseconds
+        # are folded into a single search, run at most search_max_wait
+        # milliseconds after the first one (0 runs every search at once)
+        self.search_debounce = getattr(meta, 'search_debounce', 0)
+        self.search_max_wait = getattr(meta, 'search_max_wait', 500)
+        # Asynchronous searches finish as soon as their first
+        # search_first_page rows are in the results model, the others are
+        # appended afterwards in idle callbacks, each one spending at most
+        # search_page_budget milliseconds (0 delivers every row at once).
+        # The first page is cut short when a row is added more than
+        # search_first_page_wait milliseconds after the search started
+        # (0 waits for the whole page).
+        self.search_first_page = getattr(meta, 'search_first_page', 0)
+        self.search_page_budget = getattr(meta, 'search_page_budget', 20)
+        self.search_first_page_wait = getattr(meta, 'search_first_page_wait', 0)
 
         self.description = getattr(meta, 'description', '%s Lens' % self.name.title())
         self.search_hint = getattr(meta, 'search_hint', '%s Search' % self.name.title())
@@ -114,6 +135,39 @@ class LensMeta(object):
         return [self.filter_dict[f] for f in self.filter_order]
 
 
+class ResultRows(list):
+    '''
+    Collects result rows with the same append() signature as the results
+    model, so that they can be computed away from the main loop and copied
+    to the model afterwards
+
+    If first_page is not 0, on_first_page is called (in the thread adding
+    the rows) with the ResultRows object as soon as it has first_page rows,
+    or as soon as a row is added after deadline (a GLib monotonic time, if
+    not None), and first_page_sent becomes True. first_page is then the
+    number of rows of the first page, delivery is set once they are in the
+    results model.
+    '''
+
+    def __init__(self, first_page=0, on_first_page=None, deadline=None):
+        super(ResultRows, self).__init__()
+        self.first_page = first_page
+        self.on_first_page = on_first_page
+        self.deadline = deadline
+        self.first_page_sent = False
+        self.delivery = None
+
+    def append(self, *row):
+        super(ResultRows, self).append(row)
+        if self.first_page_sent or self.first_page == 0:
+            return
+        if len(self) == self.first_page or \
+                (self.deadline is not None and GLib.get_monotonic_time() >= self.deadline):
+            self.first_page = len(self)
+            self.first_page_sent = True
+            self.on_first_page(self)
+
+
 class Lens(object):
     __metaclass__ = LensBuilder
     
@@ -156,6 +210,22 @@ class SingleScopeLens(Lens):
 
         # Populate scopes
         self._scope = Unity.Scope.new ("%s/main" % self._meta.bus_path)
+        # Rows of the last asynchronous search, to update only what changed
+        self._model_diff = ModelDiff()
+        # Debounced events: (search, search_type, cancellable) of the last
+        # search-changed, True if filters-changed was received
+        self._pending_search = None
+        self._pending_filters = False
+        # Timeout running the pending events, and when the first came
+        self._pending_source = None
+        self._burst_start = None
+        # The next search-changed comes from the debounced filters
+        self._run_next_search = False
+        # See get_search_key
+        self._last_search_key = None
+        # Increased every time the results model gets new results, so that
+        # the rows still being appended for an older search are dropped
+        self._delivery = 0
         self._scope.connect ("search-changed", self.on_search_changed)
         self._scope.connect ("filters-changed", self.on_filtering_changed);
         self._scope.connect('preview-uri', self.on_preview_uri)
@@ -168,17 +238,76 @@ class SingleScopeLens(Lens):
         self._lens.export ()
 
     def on_search_changed (self, entry, search, search_type, cancellable):
+        if self._meta.search_debounce <= 0 or self._run_next_search or \
+                search_type == Unity.SearchType.GLOBAL:
+            self._run_next_search = False
+            self._run_search(search, search_type, cancellable)
+            return
+        if self._pending_search is not None:
+            # Superseded before starting
+            self._pending_search[0].finished()
+        self._pending_search = (search, search_type, cancellable)
+        self._schedule_pending()
+
+    def _schedule_pending(self):
+        now = GLib.get_monotonic_time() / 1000
+        if self._burst_start is None:
+            self._burst_start = now
+        delay = min(self._meta.search_debounce,
+                    max(0, self._burst_start + self._meta.search_max_wait - now))
+        if self._pending_source is not None:
+            GLib.source_remove(self._pending_source)
+        self._pending_source = GLib.timeout_add(int(delay), self._run_pending)
+
+    def _run_pending(self):
+        self._pending_source = None
+        self._burst_start = None
+        pending, self._pending_search = self._pending_search, None
+        if self._pending_filters:
+            # The search must see the new filters: a new one replaces the
+            # pending search, without waiting again
+            self._pending_filters = False
+            if pending is not None:
+                pending[0].finished()
+            self._run_next_search = True
+            self._scope.queue_search_changed(Unity.SearchType.DEFAULT)
+        elif pending is not None:
+            self._run_search(*pending)
+        return False
+
+    def _run_search(self, search, search_type, cancellable):
 
 #        if search:
 #            search_string = search.props.search_string
 #        else:
 #            search_string = None
         search_string = search.props.search_string
+        if isinstance(search_string, str):
+            # PyGI returns UTF-8 byte strings, the lenses get unicode
+            search_string = search_string.decode('utf-8', 'replace')
 
         #if self._meta.search_on_blank or (search_string is not None and search_string != ''):
         if self._meta.search_on_blank or (search_string is not None):
             results = search.props.results_model
+            if self._meta.async_search and search_type != Unity.SearchType.GLOBAL:
+                if cancellable.is_cancelled():
+                    search.finished()
+                    return
+                # The state is read here, as the filters belong to the main loop
+                state = self.get_search_state()
+                key = self.get_search_key(search_string, state)
+                if key is not None and key == self._last_search_key:
+                    # Same results as the ones displayed
+                    search.finished()
+                    return
+                # search.finished() is called once the worker is done, or
+                # once the first page of results is displayed
+                self._start_async_search(search, search_string, results, state, key, cancellable)
+                return
             results.clear()
+            self._model_diff.reset()
+            self._last_search_key = None
+            self._delivery += 1
             if not cancellable.is_cancelled():
                 if search_type == Unity.SearchType.GLOBAL:
                     pass
@@ -187,8 +316,84 @@ class SingleScopeLens(Lens):
                     self.search(search_string, results)
         search.finished()
 
+    def _start_async_search(self, search, phrase, results, state, key, cancellable):
+        def first_page(rows):
+            GLib.idle_add(self._deliver_first_page, search, results, rows, key, cancellable)
+
+        deadline = None
+        if self._meta.search_first_page_wait > 0:
+            deadline = GLib.get_monotonic_time() + self._meta.search_first_page_wait * 1000
+
+        def worker():
+            rows = ResultRows(self._meta.search_first_page, first_page, deadline)
+            if not cancellable.is_cancelled():
+                try:
+                    self.search_async(phrase, rows, state, cancellable)
+                except Exception:
+                    traceback.print_exc()
+                    del rows[:]
+            GLib.idle_add(self._finish_async_search, search, results, rows, key, cancellable)
+
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    def _deliver_first_page(self, search, results, rows, key, cancellable):
+        # Runs before _finish_async_search, the search is finished with its
+        # first page of results (the worker may be adding more rows)
+        if not cancellable.is_cancelled():
+            self._model_diff.update(results, rows[:rows.first_page])
+            self._last_search_key = key
+            self._delivery += 1
+            rows.delivery = self._delivery
+        search.finished()
+        return False
+
+    def _finish_async_search(self, search, results, rows, key, cancellable):
+        if rows.first_page_sent:
+            # If the first page was displayed, the rest of the rows follow
+            # (unless newer results are displayed meanwhile), even if the
+            # search has been cancelled since
+            if rows.delivery is not None:
+                GLib.idle_add(self._append_rows, results, rows, rows.first_page, rows.delivery)
+            return False
+        # A cancelled search has been superseded by a newer one, which
+        # will update the results
+        if not cancellable.is_cancelled():
+            self._model_diff.update(results, rows)
+            self._last_search_key = key
+            self._delivery += 1
+        search.finished()
+        return False
+
+    def _append_rows(self, results, rows, start, delivery):
+        '''
+        Appends to the results model the rows from start on, for at most
+        search_page_budget milliseconds, and schedules itself again for the
+        rest. Stops if newer results were delivered.
+        '''
+        if delivery != self._delivery:
+            return False
+        deadline = GLib.get_monotonic_time() + self._meta.search_page_budget * 1000
+
+        def budgeted():
+            for index in xrange(start, len(rows)):
+                # At least one row each time
+                if index > start and GLib.get_monotonic_time() >= deadline:
+                    return
+                yield rows[index]
+
+        start += self._model_diff.append(results, budgeted())
+        if start < len(rows):
+            GLib.idle_add(self._append_rows, results, rows, start, delivery)
+        return False
+
     def on_filtering_changed(self, *_):
-        self._scope.queue_search_changed(Unity.SearchType.DEFAULT)
+        if self._meta.search_debounce <= 0:
+            self._scope.queue_search_changed(Unity.SearchType.DEFAULT)
+            return
+        self._pending_filters = True
+        self._schedule_pending()
         
     def hide_dash_response(self, uri=''):
         return Unity.ActivationResponse(handled=Unity.HandledType.HIDE_DASH, goto_uri=uri)
@@ -201,3 +406,30 @@ class SingleScopeLens(Lens):
 
     def search(self, phrase, results):
         pass
+
+    def get_search_state(self):
+        '''
+        Called in the main loop before an asynchronous search starts, returns
+        whatever search_async needs to know about the lens (e.g. filters)
+        '''
+        return None
+
+    def get_search_key(self, phrase, state):
+        '''
+        Called in the main loop before an asynchronous search starts, with
+        the state returned by get_search_state. Searches with the same key
+        as the one displayed are not run again; None (the default) always
+        runs the search.
+        '''
+        return None
+
+    def search_async(self, phrase, results, state, cancellable):
+        '''
+        Called in a worker thread when Meta.async_search is True. results is a
+        ResultRows object, copied to the results model when the search is over
+        (or, with Meta.search_first_page, as soon as the first page is there:
+        the rows should be appended as they are ready, best first, and the
+        first ones computed before the others).
+        Long searches should check cancellable.is_cancelled() and return early.
+        '''
+        self.search(phrase, results)
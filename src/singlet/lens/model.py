@@ -0,0 +1,170 @@
+#! /usr/bin/python
+
+#    Copyright (c) 2011 David Calle <davidc@framli.eu>
+#    Copyright (c) 2011 Michael Hall <mhall119@gmail.com>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+
+
+def longest_increasing_subsequence(values):
+    '''
+    Returns the set of the positions of a longest strictly increasing
+    subsequence of values (O(n log n))
+    '''
+    # tails[k]: position of the smallest last value of an increasing
+    # subsequence of length k + 1
+    tails = []
+    tail_values = []
+    previous = [None] * len(values)
+    for i, value in enumerate(values):
+        k = bisect.bisect_left(tail_values, value)
+        if k > 0:
+            previous[i] = tails[k - 1]
+        if k == len(tails):
+            tails.append(i)
+            tail_values.append(value)
+        else:
+            tails[k] = i
+            tail_values[k] = value
+    positions = set()
+    i = tails[-1] if tails else None
+    while i is not None:
+        positions.add(i)
+        i = previous[i]
+    return positions
+
+
+class ModelDiff(object):
+    '''
+    Updates a results model to contain a new list of rows, touching only
+    the rows that changed, so that the update sent to Unity is as small as
+    the change.
+
+    The rows are identified by their first column (the URI). The rows kept
+    in the same order stay where they are (the others are moved), rows
+    whose other columns changed are updated in place, and all the changes
+    are made in a single changeset when the model supports it.
+
+    The content of the model is remembered between updates, reset() must
+    be called if the model is changed in other ways.
+    '''
+
+    def __init__(self):
+        self._rows = []
+        self._model = None
+
+    def reset(self):
+        self._rows = []
+        self._model = None
+
+    def update(self, model, rows):
+        '''
+        Makes model contain rows (a sequence of tuples, in the column order
+        of the model)
+        '''
+        rows = [tuple(row) for row in rows]
+        has_changeset = hasattr(model, 'begin_changeset')
+        if has_changeset:
+            model.begin_changeset()
+        try:
+            iters = self._current_iters(model)
+            keys = [row[0] for row in rows]
+            if iters is None or len(set(keys)) != len(keys):
+                # Unknown content or ambiguous rows: replace everything
+                model.clear()
+                for row in rows:
+                    model.append(*row)
+            else:
+                self._apply(model, iters, rows)
+        finally:
+            if has_changeset:
+                model.end_changeset()
+        self._rows = rows
+        self._model = model
+
+    def append(self, model, rows):
+        '''
+        Appends rows to model, which must contain the rows of the last
+        update (or append), and returns how many were appended. rows can
+        be an iterator stopping early, e.g. to bound the time spent.
+        '''
+        if model is not self._model:
+            raise ValueError('The model was not updated by this ModelDiff')
+        has_changeset = hasattr(model, 'begin_changeset')
+        if has_changeset:
+            model.begin_changeset()
+        count = 0
+        try:
+            for row in rows:
+                row = tuple(row)
+                model.append(*row)
+                self._rows.append(row)
+                count += 1
+        finally:
+            if has_changeset:
+                model.end_changeset()
+        return count
+
+    def _current_iters(self, model):
+        '''
+        Returns the iterators of the rows of model, in order, or None if
+        they don't match the remembered rows
+        '''
+        if model is not self._model or model.get_n_rows() != len(self._rows):
+            return None
+        iters = []
+        it = model.get_first_iter()
+        end = model.get_last_iter()
+        while it != end:
+            iters.append(it)
+            it = model.next(it)
+        return iters
+
+    def _apply(self, model, iters, rows):
+        new_positions = dict((row[0], i) for i, row in enumerate(rows))
+
+        # Old rows still present, in their current order
+        kept = []
+        for old_row, it in zip(self._rows, iters):
+            position = new_positions.get(old_row[0])
+            if position is None:
+                model.remove(it)
+            else:
+                kept.append((position, old_row, it))
+
+        # The longest run already in the new order stays, the others move
+        staying = longest_increasing_subsequence([position for position, _, _ in kept])
+        kept_iters = {}
+        for i, (position, old_row, it) in enumerate(kept):
+            if i in staying:
+                kept_iters[position] = (old_row, it)
+            else:
+                model.remove(it)
+
+        # Insert from the end, each row before the one following it
+        next_iter = None
+        for position in xrange(len(rows) - 1, -1, -1):
+            row = rows[position]
+            entry = kept_iters.get(position)
+            if entry is not None:
+                old_row, it = entry
+                if old_row != row:
+                    model.set_row(it, row)
+            elif next_iter is None:
+                it = model.append(*row)
+            else:
+                it = model.insert_before(next_iter, *row)
+            next_iter = it
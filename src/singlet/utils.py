@@ -42,6 +42,8 @@ def run_lens(lens_class, args=None):
         print >> sys.stderr, "Failed to own name %s. Bailing out." % lens_class._meta.bus_name
         raise SystemExit (1)
     
+    # Lenses may search in worker threads
+    GObject.threads_init()
     lens = lens_class()
     GObject.MainLoop().run()        
 